@@ -3,13 +3,17 @@ import sys
 import os
 from datetime import datetime
 from random import randint
-import sqlite3
 import logging
+import multiprocessing
 
 from PyQt4 import QtGui, QtCore
 
 import examparser
+import grader
+import jobs
+import scoring
 import xls
+from database import Database
 
 
 def getMainWindow():
@@ -357,6 +361,7 @@ class ExamsManager(QtGui.QFrame):
         reportButton.clicked.connect(self.generateSpreadsheet)
         
         self.checkImagesTask = ImageReadThread()
+        self.checkImagesTask.pageRead.connect(self.onPageRead)
         self.checkImagesTask.taskFinished.connect(self.onImageReadFinished)
         
         controls = QtGui.QVBoxLayout()
@@ -563,121 +568,57 @@ class ExamsManager(QtGui.QFrame):
         examId = item.getCustomData()["exam_id"]
     
         files = QtGui.QFileDialog.getOpenFileNames(self, 'Open Image files')
+        if not files:
+            return
+        
+        # pick up where an interrupted read of the same files stopped
+        job = jobs.Job.start(self.db, examId, map(str, files))
+        pending = job.pending()
+        if job.resumed:
+            QtGui.QMessageBox.information(self, 'Resume',
+                "These images were partly read before, reading the "
+                "remaining %s of %s image(s)" % (len(pending), len(files)))
+        self.batch = grader.BatchIngest(self.db, examId, job)
         
         # setup thread
-        self.checkImagesTask.init(examId, files)
+        self.checkImagesTask.init(examId, pending)
         
         dialog = ProgressDialog()
-        dialog.setProgressBarMax(len(files))
+        dialog.setProgressBarMax(len(pending))
         dialog.setTask(self.checkImagesTask)
         dialog.run()
 
         
-    def onImageReadFinished(self, examId, files, data):
-            
-        student_ids = {}
-        for student_num, stud_data in data.iteritems():
-            parts = stud_data["parts"]
-            # retrieve student id
-            try:
-                student_id = student_ids[student_num]
-            except KeyError:
-                student_id = self.db.getStudent(student_num)
-                # if not exists insert
-                if student_id is None:
-                    student_id = self.db.insertStudents(student_num,
-                                                        str(student_num),
-                                                        "", "")
-                else:
-                    student_id = student_id["student_id"]
-                student_ids[student_num] = student_id
+    def onPageRead(self, result):
+        self.batch.add(result)
+
+    def onImageReadFinished(self, examId, files):
             
-            for part, items in parts.iteritems():
-                for item, ans in items.iteritems():
-                    if len(ans) > 0 and ans.upper() in "ABCDE":
-                        rpart = part + 1
-                        self.db.insertAnswer(examId, rpart, item, ans,
-                                             student_id, commit=False)
-        self.db.commit()
+        counts = self.batch.finish()
+        flagged = counts["flagged"]
+        unreadable = counts["unreadable"]
         
         # update student count
         studCount = self.db.countExamStudents(examId)
         self.studCountField.setText("# of Students checked: %s" % studCount)
         
-        self.readImageSuccess("Successfully Read %s image(s)" % len(files))
+        msg = "Successfully Read %s image(s)" % len(files)
+        msg += ("\n%(inserted)s answer(s) saved, %(replaced)s replaced" %
+                counts)
+        if flagged:
+            msg += ("\n\nCould not clearly tell page one from page two, "
+                    "please check:\n%s" % "\n".join(flagged))
+        if unreadable:
+            msg += ("\n\nUnable to read, please check:\n%s" %
+                    "\n".join(unreadable))
+        self.readImageSuccess(msg)
 
 
     def computeRawScores(self, examId):
-        # get correct answers
-        answerKey = self.db.getCorrectExamAnswers(examId)
-        students = self.db.getExamStudentAnswers(examId)
-        
-        scores = {}
-        for stud_num, student in students.iteritems():
-            scores[stud_num] = dict([(x, 0) for x in range(1, 10)])
-            for part_num, part in student.iteritems():
-                for item, ans in part.iteritems():
-                    try:
-                        correct = answerKey[part_num][item]
-                    except KeyError:
-                        # no correct answer given
-                        correct = ""
-                    if len(ans) > 0 and correct.upper() == ans.upper():
-                        scores[stud_num][part_num] += 1
-        # get students in exam
-        raw = []
-        db_studs = dict([(x["student_id"], x) for x in self.db.getStudents()])
-        
-        for stud_id, score in scores.iteritems():
-            sdata = db_studs[stud_id]
-            data = {"name": sdata["name"],
-                    "bsa_code": sdata["bsa_code"],
-                    "student_num": sdata["student_num"]}
-            total = 0
-            # format part scores for generation
-            for prt, scre in score.iteritems():
-                data["part" + str(prt)] = scre
-                total += scre
-            data["total"] = total
-            raw.append(data)
-        return raw
-
+        return scoring.compute_raw_scores(self.db, examId)
 
     def getNoTakeStudents(self, examId):
-        # add no take students
-        data = self.db.getNoTakeStudents(examId)
-        result = []
-        for row in data:
-            result.append({"name": row[0],
-                           "bsa_code": row[2],
-                           "student_num": row[1]})
-        return result
-
-    def getTopPerSubject(self, raw_scores, num=3):
-        parts = {}
-        for i in range(1, 10):
-            parts[i] = sorted(raw_scores, key=lambda k: k['part' + str(i)],
-                              reverse=True)
-
-        for i, part in parts.iteritems():
-            top = []
-            for row in part:
-                score = row["part" + str(i)]
-                if (len(top) < num or
-                    (len(top) and top[-1]["part" + str(i)] == score)):
-                    top.append(row)
-            parts[i] = top
-        return parts
-
-    def getTopStudents(self, raw_scores, num=10, num2=30):
-        ranked = []
-        ltotal = sorted(raw_scores, key=lambda k: k["total"], reverse=True)
-        for t in ltotal:
-            score = t["total"]
-            if (len(ranked) < num or
-                (len(ranked) and ranked[-1]["total"] == score)):
-                ranked.append(t)
-        return ranked, ltotal
+        return grader.get_no_take_students(self.db, examId)
 
 
     def generateSpreadsheet(self):
@@ -692,7 +633,6 @@ class ExamsManager(QtGui.QFrame):
         examId = examData["exam_id"]
         name = "%s_%s" % (examData["name"], date.strftime("%Y-%m-%d"))
         
-        TOP_SUBJECT_COUNT = 3
         raw_scores = self.computeRawScores(examId)
         
         if len(raw_scores) == 0:
@@ -701,30 +641,15 @@ class ExamsManager(QtGui.QFrame):
                 "been read using the 'Read Exam Papers' button above.")
             return
         
-        top, others = self.getTopStudents(raw_scores)
-        
-        # compute success (top 30)
-        top30 = []
-        for t in others:
-            score = t["total"]
-            if (len(top30) < 30 or
-                (len(top30) and top30[-1]["total"] == score)):
-                top30.append(t)
-        
         # compute scores and ranking
-        data = {"raw_scores": raw_scores,
-                "no_takes": self.getNoTakeStudents(examId),
-                "subject_top": self.getTopPerSubject(raw_scores),
-                "top_students": top,
-                "success_students": top30,
-                "students": others}
+        data = grader.report_data(self.db, examId, raw_scores)
         
         fname = QtGui.QFileDialog.getSaveFileName(self, "Save Spreadsheet",
                                                   '%s.xls' % name, "*.xls")
         if not fname:
             return
         try:
-            xls.generate('resources/rank.xls', fname, data)
+            xls.generate(grader.REPORT_TEMPLATE, fname, data)
             QtGui.QMessageBox.information(self, 'Spreadsheet Generated',
                 "Spreadsheet saved to:\n %s" % fname)
         except IOError as err:
@@ -735,7 +660,10 @@ class ExamsManager(QtGui.QFrame):
             
 class ImageReadThread(QtCore.QThread):
     notifyProgress = QtCore.pyqtSignal(int)
-    taskFinished = QtCore.pyqtSignal(int, list, dict)
+    # examparser.PageResult of each file, saved by the main thread as
+    # they come since sqlite connections stay in their thread
+    pageRead = QtCore.pyqtSignal(object)
+    taskFinished = QtCore.pyqtSignal(int, list)
     
     def init(self, examId, files):
         self.examId = examId
@@ -743,14 +671,21 @@ class ImageReadThread(QtCore.QThread):
     
     def run(self):
         files = self.files
-        data = None
-        cnt = 0
-        for tdata in examparser.check_images_generator(map(str, files)):
-            data = tdata
-            cnt += 1
-            self.notifyProgress.emit(cnt)
+        # connect in this thread, sqlite connections stay in their thread
+        cache = examparser.ParseCache()
+        pool = examparser.create_pool()
+        try:
+            pages = examparser.read_pages(files, pool, cache=cache)
+            for cnt, result in enumerate(pages, 1):
+                self.pageRead.emit(result)
+                self.notifyProgress.emit(cnt)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            cache.close()
         
-        self.taskFinished.emit(self.examId, list(files), data)
+        self.taskFinished.emit(self.examId, list(files))
 
 
 class ProgressDialog(QtGui.QDialog):
@@ -1061,180 +996,6 @@ class StudentsTable(QtGui.QTableWidget):
         return self.deleted
 
 
-class Database():
-    _instance = None
-    database = 'resources/data.sqlite'
-    
-    class DuplicateError(Exception):
-        pass
-    
-    def __new__(cls, *args, **kwargs):
-        if not cls._instance:
-            cls._instance = super(Database, cls).__new__(cls, *args, **kwargs)
-        return cls._instance
-
-    def __init__(self):
-        self.connect()
-    
-    def connect(self):
-        self.conn = sqlite3.connect(self.database,
-                                    detect_types=sqlite3.PARSE_DECLTYPES)
-        self.cursor = self.conn.cursor()
-
-    def commit(self):
-        self.conn.commit()
-
-    # STUDENTS *****************
-    def getStudents(self):
-        self.cursor.execute("SELECT * FROM `students`")
-        students = self.cursor.fetchall()
-        rows = []
-        for row in students:
-            rows.append({"student_id": row[0],
-                         "student_num": row[1],
-                         "name": row[2],
-                         "bsa_code": row[3],
-                         "year_level": row[4]})
-        return rows
-        
-    def getStudent(self, student_num):
-        self.cursor.execute("SELECT * FROM `students` WHERE `student_num`=?",
-                            (student_num,))
-        row = self.cursor.fetchone()
-        if row is None:
-            return row
-        return {"student_id": row[0],
-                 "student_num": row[1],
-                 "name": row[2],
-                 "bsa_code": row[3],
-                 "year_level": row[4]}
-
-    def insertStudents(self, student_num, name, bsa_code, year_level):
-        try:
-            self.cursor.execute("INSERT INTO `students` (`student_num`, `name`, "
-                                "`bsa_code`, `year_level`) "
-                                "VALUES (?, ?, ?, ?)", (student_num, name,
-                                                        bsa_code, year_level))
-            self.conn.commit()
-        except sqlite3.IntegrityError as err:
-            raise self.DuplicateError("The student Number '%s' is already "
-                                      "used by another student" % student_num)
-        return self.cursor.lastrowid
-
-    def updateStudents(self, sid, student_num, name, bsa_code, year_level):
-        try:
-            self.cursor.execute("UPDATE `students` SET `student_num`=?, "
-                                "`name`=?, `bsa_code`=?, `year_level`=? "
-                                "WHERE student_id=?", (student_num, name,
-                                                       bsa_code, year_level,
-                                                       sid))
-        except sqlite3.IntegrityError as err:
-            raise self.DuplicateError("The student Number '%s' is already "
-                                      "used by another student" % student_num)
-
-    def deleteStudents(self, sid):
-        if isinstance(sid, list):
-            quer = ", ".join([str(x) for x in sid])
-            self.cursor.execute("DELETE FROM `students` "
-                                "WHERE `student_id` in (%s)" % quer)
-        else:
-            self.cursor.execute("DELETE FROM `students` "
-                                "WHERE `student_id`=?", (sid,))
-
-
-    # EXAMS *****************
-    def getExams(self):
-        self.cursor.execute("SELECT * FROM `exams`")
-        exams = self.cursor.fetchall()
-        rows = []
-        for row in exams:
-            rows.append({"exam_id": row[0],
-                         "name": row[1],
-                         "date": row[2],
-                         "semester": row[3]})
-        return rows
-
-    def insertExam(self, name, date, semester):
-        self.cursor.execute("INSERT INTO `exams` (`name`, `date`, `semester`) "
-                            "VALUES (?, ?, ?)", (name, date, semester))
-        self.conn.commit()
-        return self.cursor.lastrowid
-
-    def updateExam(self, eid, name, date, semester):
-        self.cursor.execute("UPDATE `exams` SET `name`=?, "
-                            "`date`=?, `semester`=? WHERE exam_id=?",
-                            (name, date, semester, eid))
-
-    def deleteExams(self, eid):
-        if isinstance(eid, list):
-            quer = ", ".join([str(x) for x in eid])
-            self.cursor.execute("DELETE FROM `exams` "
-                                "WHERE `exam_id` in (%s)" % quer)
-        else:
-            self.cursor.execute("DELETE FROM `exams` "
-                                "WHERE `exam_id`=?", (eid,))
-
-
-    def countExamStudents(self, examId):
-        self.cursor.execute("SELECT `answer_id` FROM `answers` "
-                            "WHERE `student_id` != 0 AND `exam_id`=? "
-                            "GROUP BY `student_id`", (examId,))
-        return len(self.cursor.fetchall())
-            
-
-    def getNoTakeStudents(self, examId):
-        sql = ("SELECT `name`, `student_num`, `bsa_code` "
-               "FROM students WHERE student_id NOT IN "
-               "(SELECT DISTINCT student_id "
-               " FROM `answers` "
-               " WHERE `exam_id`=? "
-               " AND `student_id`!=0)")
-        self.cursor.execute(sql, (examId,))
-        return self.cursor.fetchall()
-
-    # EXAM ANSWERS *****************
-    def getCorrectExamAnswers(self, examId):
-        self.cursor.execute("SELECT * FROM `answers`"
-                            "WHERE `exam_id`=? AND `student_id`=0", (examId,))
-        answers = self.cursor.fetchall()
-        data = dict([(x, {}) for x in range(1, 10)])
-        for row in answers:
-            aid, eid, stud_num, part, item, answer = row
-            data[part][item] = answer
-        return data
-    
-    def saveExamAnswers(self, examId, data):
-        for part in data.keys():
-            for item in data[part].keys():
-                answer = data[part][item]
-                self.insertAnswer(examId, part, item, answer, commit=False)
-
-
-    def getExamStudentAnswers(self, examId):
-        self.cursor.execute("SELECT * FROM `answers` "
-                            "WHERE `exam_id`=? "
-                            "AND `student_id`!=0", (examId,))
-        answers = self.cursor.fetchall()
-        students = {}
-        for row in answers:
-            aid, eid, stud_num, part, item, answer = row
-            if stud_num not in students.keys():
-                students[stud_num] = dict([(x, {}) for x in range(1, 10)])
-            students[stud_num][part][item] = answer
-        return students
-
-    # ANSWERS **********************
-    def insertAnswer(self, exam_id, part, item, answer, student_id=0,
-                     commit=True):
-        self.cursor.execute("INSERT INTO `answers` (`exam_id`, `student_id`, "
-                            "`part`, `item`, `answer`) "
-                            "VALUES (?, ?, ?, ?, ?)", (exam_id, student_id,
-                                                       part, item, answer))
-        if commit:
-            self.conn.commit()
-        return self.cursor.lastrowid
-
-
 class LoggerWriter:
     def __init__(self, logger, level):
         self.logger = logger
@@ -1262,5 +1023,7 @@ def main():
     sys.exit(app.exec_())
 
 if __name__ == '__main__':
+    # needed by the image reading process pool on frozen windows builds
+    multiprocessing.freeze_support()
     initLogger()
     main()
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+"""
+Benchmark reading exam papers and check the answers read against a
+golden output
+
+usage: bench.py [PATH ...] [-w WORKERS] [-n REPEAT] [-g GOLDEN] [--update]
+
+Times each stage of reading a page, pages per second for each number of
+worker processes and peak memory. Exits with 1 when any page is read
+differently from the golden output.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+import examparser
+import grader
+
+
+# images read by default, including the blank pages
+PAPERS = 'test_papers'
+# answers read from every paper in PAPERS
+GOLDEN = 'test_papers/golden.json'
+# stages of examparser.read_image in order, as profiled
+STAGES = ["decode", "threshold", "corners", "warp", "marker", "read"]
+
+
+def answers(data):
+    """
+    Student number and answers of page or student data, as stored in
+    the golden output
+    """
+    parts = {}
+    for part, items in data["parts"].iteritems():
+        parts[str(part)] = dict((str(item), ans)
+                                for item, ans in items.iteritems())
+    return {"student_num": data["student_num"], "parts": parts}
+
+
+def peak_rss():
+    """
+    Peak resident memory of this process and of its finished
+    children, in KB
+    """
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def bench_stages(files, repeat=1, scoring=None):
+    """
+    Read every file repeat times one after another
+
+    returns answers per file name and best total seconds per stage
+    """
+    best = None
+    pages = {}
+    for run in range(repeat):
+        profile = examparser.enable_profiling()
+        try:
+            for fname in files:
+                data = examparser.read_image(fname, scoring)
+                examparser.profiled(data)
+                pages[os.path.basename(fname)] = answers(data)
+        finally:
+            examparser.disable_profiling()
+        totals = dict((x, 0.0) for x in STAGES)
+        totals.update(profile.summary()["stages"])
+        if best is None or sum(totals.values()) < sum(best.values()):
+            best = totals
+    return pages, best
+
+
+def bench_workers(files, workers, repeat=1, scoring=None):
+    """
+    Read every file with check_images_parallel for each number of
+    workers
+
+    returns list of (workers, best seconds, students read)
+    """
+    results = []
+    for count in workers:
+        best = None
+        for run in range(repeat):
+            start = time.time()
+            students = examparser.merge_pages(
+                examparser.check_images_parallel(files, count, scoring))
+            seconds = time.time() - start
+            best = seconds if best is None else min(best, seconds)
+        results.append((count, best, students))
+    return results
+
+
+def compare(pages, golden):
+    """
+    returns names of files read differently than in golden, or not in it
+    """
+    return sorted(name for name in pages
+                  if golden.get(name) != pages[name])
+
+
+def merged_golden(golden, files):
+    """
+    Answers per student num, every item of every page of the student,
+    merged here rather than with merge_pages so the check covers it
+    """
+    students = {}
+    for fname in files:
+        page = golden[os.path.basename(fname)]
+        parts = students.setdefault(page["student_num"], {})
+        for part, items in page["parts"].iteritems():
+            parts.setdefault(int(part), {}).update(
+                (int(item), ans) for item, ans in items.iteritems())
+    return dict((num, answers({"student_num": num, "parts": parts}))
+                for num, parts in students.iteritems())
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark reading exam papers and check the answers "
+                    "read against a golden output")
+    parser.add_argument("paths", nargs="*", metavar="PATH", default=[PAPERS],
+                        help="image file, directory or glob pattern "
+                             "(default: %(default)s)")
+    parser.add_argument("-w", "--workers", default="1,2,4",
+                        help="comma separated worker counts to time "
+                             "(default: %(default)s)")
+    parser.add_argument("-n", "--repeat", type=int, default=1,
+                        help="runs per measurement, the best one is "
+                             "reported (default: %(default)s)")
+    parser.add_argument("-g", "--golden", default=GOLDEN,
+                        help="golden output file (default: %(default)s)")
+    parser.add_argument("--update", action="store_true",
+                        help="write the answers read as the golden output")
+    parser.add_argument("-s", "--scoring", default=examparser.SCORING,
+                        choices=[examparser.SCORING_POINTS,
+                                 examparser.SCORING_AREA],
+                        help="how circles are scored (default: %(default)s)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    files = grader.find_images(args.paths)
+    if not files:
+        print >>sys.stderr, "No image files found"
+        return 1
+    workers = [int(x) for x in args.workers.split(",") if x]
+
+    # static resources are loaded once per process, not per page
+    examparser.load_resources()
+    pages, stages = bench_stages(files, args.repeat, args.scoring)
+    total = sum(stages.values())
+    print "%s page(s), stages in ms per page:" % len(files)
+    for stage in STAGES:
+        print "  %-10s %8.1f  %5.1f%%" % (stage,
+                                          stages[stage] * 1000 / len(files),
+                                          stages[stage] * 100 / total)
+    print "  %-10s %8.1f  (%.2f pages/sec)" % ("total",
+                                                total * 1000 / len(files),
+                                                len(files) / total)
+
+    print "workers  seconds  pages/sec  speedup"
+    timed = bench_workers(files, workers, args.repeat, args.scoring)
+    for count, seconds, students in timed:
+        print "%7s  %7.2f  %9.2f  %7.2f" % (count, seconds,
+                                            len(files) / seconds,
+                                            timed[0][1] / seconds)
+    own, children = peak_rss()
+    print "peak rss: %s KB, largest worker: %s KB" % (own, children)
+
+    if args.update:
+        with open(args.golden, "w") as f:
+            json.dump(pages, f, sort_keys=True, indent=1)
+        print "Golden output saved to: %s" % args.golden
+        return 0
+
+    try:
+        with open(args.golden) as f:
+            golden = json.load(f)
+    except IOError:
+        print >>sys.stderr, "No golden output, run with --update first"
+        return 1
+    failed = compare(pages, golden)
+    if not failed:
+        expected = merged_golden(golden, files)
+        for count, seconds, students in timed:
+            read = dict((num, answers(data))
+                        for num, data in students.iteritems())
+            if read != expected:
+                failed.append("%s worker(s)" % count)
+    for name in failed:
+        print >>sys.stderr, "Not read as in the golden output: %s" % name
+    print "golden check: %s" % ("FAILED" if failed else "ok")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
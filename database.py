@@ -0,0 +1,842 @@
+import sqlite3
+import time
+
+
+# items of parts 1 to 9 in a packed answer sheet, one byte per item
+PART_ITEMS = (120, 110, 110, 110, 110, 110, 110, 110, 110)
+PART_OFFSETS = [sum(PART_ITEMS[:i]) for i in range(len(PART_ITEMS))]
+SHEET_SIZE = sum(PART_ITEMS)
+# byte of items not answered
+BLANK = "\0"
+# options value of databases storing packed sheets instead of answer rows
+PACKED = "packed"
+
+# most host parameters sqlite allows in one statement is 999
+MAX_PARAMS = 900
+
+
+def chunks(items, size=MAX_PARAMS):
+    """
+    Split list into lists of at most size items
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def sheet_offset(part, item):
+    """
+    Position of part and item (1-based) in a packed sheet
+    """
+    if not (1 <= part <= len(PART_ITEMS) and
+            1 <= item <= PART_ITEMS[part - 1]):
+        raise ValueError("Part %s item %s is not in the answer sheet" %
+                         (part, item))
+    return PART_OFFSETS[part - 1] + item - 1
+
+
+def sheet_answer(answer):
+    """
+    Answer as stored in a packed sheet, anything but a single character
+    (a key cell of "AB" for a disputed item) never matches any student
+    and is left blank
+
+    returns the answer, empty if blank
+    """
+    if answer and len(answer) == 1 and ord(answer) < 128:
+        return answer
+    return ""
+
+
+def pack_sheet(answers, sheet=None, strict=True):
+    """
+    Write (part, item, answer) tuples into a packed sheet, empty
+    answers and those sheet_answer leaves blank clear the item. Unless
+    strict, items not in the sheet are left out, answer keys can have
+    them but no student can
+
+    returns the sheet as a bytearray
+    """
+    sheet = bytearray(sheet or BLANK * SHEET_SIZE)
+    for part, item, answer in answers:
+        try:
+            sheet[sheet_offset(part, item)] = ord(sheet_answer(answer) or
+                                                  BLANK)
+        except ValueError:
+            if strict:
+                raise
+    return sheet
+
+
+def unpack_sheet(sheet):
+    """
+    Read a packed sheet
+
+    returns answers per item per part of the answered items
+    """
+    sheet = str(sheet)
+    data = dict([(x, {}) for x in range(1, len(PART_ITEMS) + 1)])
+    for part, items in enumerate(PART_ITEMS, 1):
+        offset = PART_OFFSETS[part - 1]
+        for item, answer in enumerate(sheet[offset:offset + items], 1):
+            if answer != BLANK:
+                data[part][item] = answer
+    return data
+
+
+# schema changes in order, PRAGMA user_version counts the ones applied
+MIGRATIONS = [
+    # 1: answers by student for the delete trigger, answers by exam
+    # covering the answer so scoring and listing never read the table
+    ["CREATE INDEX IF NOT EXISTS `answers_student` "
+     "ON `answers` (`student_id`, `exam_id`)",
+     "CREATE INDEX IF NOT EXISTS `answers_exam_answer` "
+     "ON `answers` (`exam_id`, `student_id`, `part`, `item`, `answer`)"],
+    # 2: packed answer sheets, one row per student per exam, and options
+    # telling which of answers or sheets the database uses
+    ["CREATE TABLE IF NOT EXISTS `sheets` ("
+     "`exam_id` INTEGER NOT NULL, `student_id` INTEGER NOT NULL, "
+     "`answers` BLOB NOT NULL, PRIMARY KEY (`exam_id`, `student_id`))",
+     "CREATE INDEX IF NOT EXISTS `sheets_student` "
+     "ON `sheets` (`student_id`)",
+     "CREATE TABLE IF NOT EXISTS `options` ("
+     "`name` VARCHAR(32) PRIMARY KEY NOT NULL, `value` TEXT)",
+     "CREATE TRIGGER IF NOT EXISTS on_delete_exam_delete_sheets "
+     "AFTER DELETE ON `exams` BEGIN "
+     "DELETE FROM `sheets` WHERE `exam_id` = old.`exam_id`; END",
+     "CREATE TRIGGER IF NOT EXISTS on_delete_student_delete_sheets "
+     "AFTER DELETE ON `students` BEGIN "
+     "DELETE FROM `sheets` WHERE `student_id` = old.`student_id`; END"],
+    # 3: cached part scores per student per exam, the answer key
+    # (student_id 0) row counts key items and marks the exam as scored
+    ["CREATE TABLE IF NOT EXISTS `scores` ("
+     "`exam_id` INTEGER NOT NULL, `student_id` INTEGER NOT NULL, "
+     "`part` INTEGER NOT NULL, `score` INTEGER NOT NULL, "
+     "PRIMARY KEY (`exam_id`, `student_id`, `part`))",
+     "CREATE INDEX IF NOT EXISTS `scores_student` "
+     "ON `scores` (`student_id`)",
+     "CREATE TRIGGER IF NOT EXISTS on_delete_exam_delete_scores "
+     "AFTER DELETE ON `exams` BEGIN "
+     "DELETE FROM `scores` WHERE `exam_id` = old.`exam_id`; END",
+     "CREATE TRIGGER IF NOT EXISTS on_delete_student_delete_scores "
+     "AFTER DELETE ON `students` BEGIN "
+     "DELETE FROM `scores` WHERE `student_id` = old.`student_id`; END"],
+    # 4: batches of image files being read into an exam, with the status
+    # and page read of each file so an interrupted batch can resume
+    ["CREATE TABLE IF NOT EXISTS `jobs` ("
+     "`job_id` INTEGER PRIMARY KEY AUTOINCREMENT, "
+     "`exam_id` INTEGER NOT NULL, `scoring` TEXT NOT NULL, "
+     "`created` REAL NOT NULL, `finished` REAL)",
+     "CREATE INDEX IF NOT EXISTS `jobs_exam` "
+     "ON `jobs` (`exam_id`, `finished`)",
+     "CREATE TABLE IF NOT EXISTS `job_files` ("
+     "`job_id` INTEGER NOT NULL, `seq` INTEGER NOT NULL, "
+     "`file` TEXT NOT NULL, `status` VARCHAR(8) NOT NULL, "
+     "`page` TEXT, `data` TEXT, `timings` TEXT, "
+     "`saved` INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (`job_id`, `seq`))",
+     "CREATE UNIQUE INDEX IF NOT EXISTS `job_files_file` "
+     "ON `job_files` (`job_id`, `file`)",
+     "CREATE TRIGGER IF NOT EXISTS on_delete_exam_delete_jobs "
+     "AFTER DELETE ON `exams` BEGIN "
+     "DELETE FROM `jobs` WHERE `exam_id` = old.`exam_id`; END",
+     "CREATE TRIGGER IF NOT EXISTS on_delete_job_delete_files "
+     "AFTER DELETE ON `jobs` BEGIN "
+     "DELETE FROM `job_files` WHERE `job_id` = old.`job_id`; END"],
+    # 5: answers to an item of an exam, read when a key item changes
+    ["CREATE INDEX IF NOT EXISTS `answers_exam_item` "
+     "ON `answers` (`exam_id`, `part`, `item`, `student_id`, `answer`)"],
+]
+
+# queries run per exam whose plans should use an index on answers
+EXAM_STUDENTS_SQL = ("SELECT COUNT(DISTINCT `student_id`) FROM `answers` "
+                     "WHERE `exam_id`=? AND `student_id`!=0")
+NO_TAKE_SQL = ("SELECT `name`, `student_num`, `bsa_code` "
+               "FROM students WHERE student_id NOT IN "
+               "(SELECT DISTINCT student_id "
+               " FROM `answers` "
+               " WHERE `exam_id`=? "
+               " AND `student_id`!=0)")
+STUDENT_ANSWERS_SQL = ("SELECT * FROM `answers` "
+                       "WHERE `exam_id`=? "
+                       "AND `student_id`!=0")
+EXAM_SHEETS_SQL = ("SELECT s.`student_id`, s.`student_num`, s.`name`, "
+                   "s.`bsa_code`, a.`part`, a.`item`, a.`answer` "
+                   "FROM `answers` a "
+                   "JOIN `students` s ON s.`student_id` = a.`student_id` "
+                   "WHERE a.`exam_id`=? AND a.`student_id`!=0 "
+                   "ORDER BY a.`student_id`")
+ITEM_ANSWERS_SQL = ("SELECT `student_id`, `answer` FROM `answers` "
+                    "WHERE `exam_id`=? AND `part`=? AND `item`=? "
+                    "AND `student_id`!=0")
+# same lookup as the on_delete_student_delete_answers trigger
+DELETE_STUDENT_ANSWERS_SQL = "DELETE FROM `answers` WHERE `student_id`=?"
+# the same for packed sheets
+SHEET_STUDENTS_SQL = ("SELECT COUNT(*) FROM `sheets` "
+                      "WHERE `exam_id`=? AND `student_id`!=0")
+SHEET_NO_TAKE_SQL = ("SELECT `name`, `student_num`, `bsa_code` "
+                     "FROM students WHERE student_id NOT IN "
+                     "(SELECT student_id "
+                     " FROM `sheets` "
+                     " WHERE `exam_id`=? "
+                     " AND `student_id`!=0)")
+STUDENT_SHEETS_SQL = ("SELECT `student_id`, `answers` FROM `sheets` "
+                      "WHERE `exam_id`=? "
+                      "AND `student_id`!=0")
+SHEET_EXAM_SHEETS_SQL = ("SELECT s.`student_id`, s.`student_num`, "
+                         "s.`name`, s.`bsa_code`, a.`answers` "
+                         "FROM `sheets` a "
+                         "JOIN `students` s "
+                         "ON s.`student_id` = a.`student_id` "
+                         "WHERE a.`exam_id`=? AND a.`student_id`!=0 "
+                         "ORDER BY a.`student_id`")
+DELETE_STUDENT_SHEETS_SQL = "DELETE FROM `sheets` WHERE `student_id`=?"
+CHECKED_QUERIES = [("countExamStudents", EXAM_STUDENTS_SQL),
+                   ("getNoTakeStudents", NO_TAKE_SQL),
+                   ("getExamStudentAnswers", STUDENT_ANSWERS_SQL),
+                   ("getExamSheets", EXAM_SHEETS_SQL),
+                   ("getItemAnswers", ITEM_ANSWERS_SQL),
+                   ("deleteStudents", DELETE_STUDENT_ANSWERS_SQL)]
+CHECKED_SHEET_QUERIES = [("countExamStudents", SHEET_STUDENTS_SQL),
+                         ("getNoTakeStudents", SHEET_NO_TAKE_SQL),
+                         ("getExamStudentAnswers", STUDENT_SHEETS_SQL),
+                         ("getExamSheets", SHEET_EXAM_SHEETS_SQL),
+                         ("deleteStudents", DELETE_STUDENT_SHEETS_SQL)]
+
+
+class Database():
+    _instance = None
+    database = 'resources/data.sqlite'
+    
+    class DuplicateError(Exception):
+        pass
+    
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super(Database, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self):
+        self.connect()
+    
+    def connect(self):
+        self.conn = sqlite3.connect(self.database,
+                                    detect_types=sqlite3.PARSE_DECLTYPES)
+        self.cursor = self.conn.cursor()
+        # readers are not blocked while answers are saved, WAL only
+        # needs a sync at checkpoints. foreign_keys stays off, the
+        # answers student_id reference points at exams and would fail
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        self.cursor.execute("PRAGMA temp_store=MEMORY")
+        self.migrate()
+        self.packed = self.getOption("storage") == PACKED
+
+    def getOption(self, name, default=None):
+        self.cursor.execute("SELECT `value` FROM `options` WHERE `name`=?",
+                            (name,))
+        row = self.cursor.fetchone()
+        return default if row is None else row[0]
+
+    def setOption(self, name, value, commit=True):
+        self.cursor.execute("INSERT OR REPLACE INTO `options` "
+                            "(`name`, `value`) VALUES (?, ?)", (name, value))
+        if commit:
+            self.conn.commit()
+
+    def packAnswers(self):
+        # move every answer row into packed sheets and store sheets from
+        # now on. returns the number of sheets written
+        if self.packed:
+            return 0
+        try:
+            self.cursor.execute("SELECT `exam_id`, `student_id`, `part`, "
+                                "`item`, `answer` FROM `answers`")
+            sheets = {}
+            for eid, sid, part, item, answer in self.cursor.fetchall():
+                sheets.setdefault((eid, sid), []).append((part, item,
+                                                          answer))
+            self.writeSheets([(eid, sid, pack_sheet(answers,
+                                                    strict=sid != 0))
+                              for (eid, sid), answers in sheets.iteritems()])
+            self.cursor.execute("DELETE FROM `answers`")
+            self.setOption("storage", PACKED, commit=False)
+            self.commit()
+        except:
+            self.conn.rollback()
+            raise
+        # give the space of the answer rows back
+        self.conn.execute("VACUUM")
+        self.packed = True
+        return len(sheets)
+
+    def schemaVersion(self):
+        self.cursor.execute("PRAGMA user_version")
+        return self.cursor.fetchone()[0]
+
+    def migrate(self):
+        # apply migrations newer than the database, each one in
+        # its own transaction together with its version number
+        version = self.schemaVersion()
+        for number, statements in enumerate(MIGRATIONS[version:],
+                                            version + 1):
+            self.conn.executescript(
+                "BEGIN; %s; PRAGMA user_version=%d; COMMIT;" %
+                ("; ".join(statements), number))
+        return self.schemaVersion()
+
+    def queryPlan(self, sql, params=()):
+        # details of sqlite's EXPLAIN QUERY PLAN for sql
+        self.cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [row[-1] for row in self.cursor.fetchall()]
+
+    def checkQueryPlans(self, examId=0):
+        # plans of the per exam queries, and whether any of them reads
+        # the whole answers table instead of an index
+        plans = []
+        queries = CHECKED_SHEET_QUERIES if self.packed else CHECKED_QUERIES
+        for name, sql in queries:
+            # the exam is the first parameter, the others are any value
+            params = (examId,) + (0,) * (sql.count("?") - 1)
+            plan = self.queryPlan(sql, params)
+            scans = [x for x in plan if x.startswith("SCAN")
+                     and ("answers" in x or "sheets" in x)]
+            plans.append((name, plan, not scans))
+        return plans
+
+    def commit(self):
+        self.conn.commit()
+
+    # STUDENTS *****************
+    def getStudents(self):
+        self.cursor.execute("SELECT * FROM `students`")
+        students = self.cursor.fetchall()
+        rows = []
+        for row in students:
+            rows.append({"student_id": row[0],
+                         "student_num": row[1],
+                         "name": row[2],
+                         "bsa_code": row[3],
+                         "year_level": row[4]})
+        return rows
+        
+    def getStudent(self, student_num):
+        self.cursor.execute("SELECT * FROM `students` WHERE `student_num`=?",
+                            (student_num,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return row
+        return {"student_id": row[0],
+                 "student_num": row[1],
+                 "name": row[2],
+                 "bsa_code": row[3],
+                 "year_level": row[4]}
+
+    def insertStudents(self, student_num, name, bsa_code, year_level):
+        try:
+            self.cursor.execute("INSERT INTO `students` (`student_num`, `name`, "
+                                "`bsa_code`, `year_level`) "
+                                "VALUES (?, ?, ?, ?)", (student_num, name,
+                                                        bsa_code, year_level))
+            self.conn.commit()
+        except sqlite3.IntegrityError as err:
+            raise self.DuplicateError("The student Number '%s' is already "
+                                      "used by another student" % student_num)
+        return self.cursor.lastrowid
+
+    def insertMissingStudents(self, student_nums, commit=False):
+        # add students not yet in the database, named after their number.
+        # returns student ids per student num and count of students added
+        student_nums = list(set(student_nums))
+        before = self.conn.total_changes
+        self.cursor.executemany("INSERT OR IGNORE INTO `students` "
+                                "(`student_num`, `name`, `bsa_code`, "
+                                "`year_level`) VALUES (?, ?, '', '')",
+                                [(x, str(x)) for x in student_nums])
+        added = self.conn.total_changes - before
+        student_ids = {}
+        for nums in chunks(student_nums):
+            self.cursor.execute("SELECT `student_num`, `student_id` "
+                                "FROM `students` WHERE `student_num` IN (%s)" %
+                                ", ".join("?" * len(nums)), nums)
+            student_ids.update(self.cursor.fetchall())
+        if commit:
+            self.conn.commit()
+        return student_ids, added
+
+    def updateStudents(self, sid, student_num, name, bsa_code, year_level):
+        try:
+            self.cursor.execute("UPDATE `students` SET `student_num`=?, "
+                                "`name`=?, `bsa_code`=?, `year_level`=? "
+                                "WHERE student_id=?", (student_num, name,
+                                                       bsa_code, year_level,
+                                                       sid))
+        except sqlite3.IntegrityError as err:
+            raise self.DuplicateError("The student Number '%s' is already "
+                                      "used by another student" % student_num)
+
+    def deleteStudents(self, sid):
+        if isinstance(sid, list):
+            quer = ", ".join([str(x) for x in sid])
+            self.cursor.execute("DELETE FROM `students` "
+                                "WHERE `student_id` in (%s)" % quer)
+        else:
+            self.cursor.execute("DELETE FROM `students` "
+                                "WHERE `student_id`=?", (sid,))
+
+
+    # EXAMS *****************
+    def getExams(self):
+        self.cursor.execute("SELECT * FROM `exams`")
+        exams = self.cursor.fetchall()
+        rows = []
+        for row in exams:
+            rows.append({"exam_id": row[0],
+                         "name": row[1],
+                         "date": row[2],
+                         "semester": row[3]})
+        return rows
+
+    def insertExam(self, name, date, semester):
+        self.cursor.execute("INSERT INTO `exams` (`name`, `date`, `semester`) "
+                            "VALUES (?, ?, ?)", (name, date, semester))
+        self.conn.commit()
+        return self.cursor.lastrowid
+
+    def updateExam(self, eid, name, date, semester):
+        self.cursor.execute("UPDATE `exams` SET `name`=?, "
+                            "`date`=?, `semester`=? WHERE exam_id=?",
+                            (name, date, semester, eid))
+
+    def deleteExams(self, eid):
+        if isinstance(eid, list):
+            quer = ", ".join([str(x) for x in eid])
+            self.cursor.execute("DELETE FROM `exams` "
+                                "WHERE `exam_id` in (%s)" % quer)
+        else:
+            self.cursor.execute("DELETE FROM `exams` "
+                                "WHERE `exam_id`=?", (eid,))
+
+
+    def countExamStudents(self, examId):
+        self.cursor.execute(SHEET_STUDENTS_SQL if self.packed
+                            else EXAM_STUDENTS_SQL, (examId,))
+        return self.cursor.fetchone()[0]
+            
+
+    def getNoTakeStudents(self, examId):
+        self.cursor.execute(SHEET_NO_TAKE_SQL if self.packed
+                            else NO_TAKE_SQL, (examId,))
+        return self.cursor.fetchall()
+
+    # EXAM ANSWERS *****************
+    def getCorrectExamAnswers(self, examId):
+        if self.packed:
+            return unpack_sheet(self.getSheet(examId, 0) or "")
+        self.cursor.execute("SELECT * FROM `answers`"
+                            "WHERE `exam_id`=? AND `student_id`=0", (examId,))
+        answers = self.cursor.fetchall()
+        data = dict([(x, {}) for x in range(1, 10)])
+        for row in answers:
+            aid, eid, stud_num, part, item, answer = row
+            data[part][item] = answer
+        return data
+    
+    def saveExamAnswers(self, examId, data):
+        # write only the key items that changed and adjust cached scores
+        # of the parts they are in. returns the number of items changed
+        current = self.getCorrectExamAnswers(examId)
+        changes = []
+        for part in data.keys():
+            for item, answer in data[part].iteritems():
+                answer = answer or ""
+                if self.packed:
+                    # packed sheets only keep what sheet_answer keeps
+                    answer = sheet_answer(answer)
+                old = current.get(part, {}).get(item) or ""
+                if answer != old:
+                    changes.append((part, item, old, answer))
+        if not changes:
+            return 0
+        if self.packed:
+            sheet = pack_sheet([x[:2] + x[3:] for x in changes],
+                               self.getSheet(examId, 0), False)
+            self.writeSheets([(examId, 0, sheet)])
+        else:
+            self.cursor.executemany("INSERT INTO `answers` (`exam_id`, "
+                                    "`student_id`, `part`, `item`, "
+                                    "`answer`) VALUES (?, 0, ?, ?, ?)",
+                                    [(examId, x[0], x[1], x[3])
+                                     for x in changes])
+        self.updateKeyScores(examId, changes)
+        return len(changes)
+
+
+    def getExamStudentAnswers(self, examId):
+        if self.packed:
+            self.cursor.execute(STUDENT_SHEETS_SQL, (examId,))
+            return dict((sid, unpack_sheet(sheet))
+                        for sid, sheet in self.cursor.fetchall())
+        self.cursor.execute(STUDENT_ANSWERS_SQL, (examId,))
+        answers = self.cursor.fetchall()
+        students = {}
+        for row in answers:
+            aid, eid, stud_num, part, item, answer = row
+            if stud_num not in students.keys():
+                students[stud_num] = dict([(x, {}) for x in range(1, 10)])
+            students[stud_num][part][item] = answer
+        return students
+
+    def getExamSheets(self, examId):
+        # packed answer key, students who took the exam and their packed
+        # sheets in the same order, whichever storage the database uses
+        key = self.getSheet(examId, 0) if self.packed else None
+        students = []
+        sheets = []
+        if self.packed:
+            self.cursor.execute(SHEET_EXAM_SHEETS_SQL, (examId,))
+            for row in self.cursor.fetchall():
+                students.append({"student_id": row[0],
+                                 "student_num": row[1],
+                                 "name": row[2],
+                                 "bsa_code": row[3]})
+                sheets.append(str(row[4]))
+            return key or BLANK * SHEET_SIZE, students, sheets
+        self.cursor.execute("SELECT `part`, `item`, `answer` FROM `answers` "
+                            "WHERE `exam_id`=? AND `student_id`=0",
+                            (examId,))
+        key = pack_sheet(self.cursor.fetchall(), strict=False)
+        # only students who took the exam, their answer rows together
+        self.cursor.execute(EXAM_SHEETS_SQL, (examId,))
+        answers = []
+        for row in self.cursor.fetchall():
+            if not students or students[-1]["student_id"] != row[0]:
+                if answers:
+                    sheets.append(pack_sheet(answers))
+                students.append({"student_id": row[0],
+                                 "student_num": row[1],
+                                 "name": row[2],
+                                 "bsa_code": row[3]})
+                answers = []
+            answers.append(row[4:])
+        if answers:
+            sheets.append(pack_sheet(answers))
+        return key, students, sheets
+
+    def saveStudentAnswers(self, examId, data):
+        # save data per student num read by examparser in one transaction,
+        # students not found are added.
+        # returns counts of students added and answers inserted or replaced
+        rows = []
+        try:
+            student_ids, added = self.insertMissingStudents(data.keys())
+            for student_num, stud_data in data.iteritems():
+                student_id = student_ids[student_num]
+                for part, items in stud_data["parts"].iteritems():
+                    for item, ans in items.iteritems():
+                        if len(ans) > 0 and ans.upper() in "ABCDE":
+                            rows.append((examId, student_id, part + 1, item,
+                                         ans))
+            self.clearScores(examId)
+            if self.packed:
+                replaced = self.saveSheetAnswers(examId, rows)
+            else:
+                replaced = self.countExistingAnswers(examId, rows)
+                self.insertAnswers(rows, commit=False)
+            self.commit()
+        except:
+            self.conn.rollback()
+            raise
+        return {"students": added,
+                "inserted": len(rows) - replaced,
+                "replaced": replaced}
+
+    def countExistingAnswers(self, examId, rows):
+        # count (exam_id, student_id, part, item, answer) rows
+        # already answered in the exam
+        keys = set((row[1], row[2], row[3]) for row in rows)
+        student_ids = list(set(row[1] for row in rows))
+        count = 0
+        for ids in chunks(student_ids):
+            self.cursor.execute("SELECT `student_id`, `part`, `item` "
+                                "FROM `answers` WHERE `exam_id`=? "
+                                "AND `student_id` IN (%s)" %
+                                ", ".join("?" * len(ids)), [examId] + ids)
+            count += len([x for x in self.cursor.fetchall() if x in keys])
+        return count
+
+    def saveSheetAnswers(self, examId, rows):
+        # write (exam_id, student_id, part, item, answer) rows into packed
+        # sheets. returns count of items that were already answered
+        answers = {}
+        for row in rows:
+            answers.setdefault(row[1], []).append(row[2:])
+        sheets = self.getSheets(examId, answers.keys())
+        replaced = 0
+        for student_id, items in answers.iteritems():
+            old = sheets.get(student_id)
+            if old is not None:
+                replaced += sum(1 for part, item, ans in items
+                                if old[sheet_offset(part, item)] != BLANK)
+            sheets[student_id] = pack_sheet(items, old)
+        self.writeSheets([(examId, sid, sheet)
+                          for sid, sheet in sheets.iteritems()])
+        return replaced
+
+    # SHEETS ***********************
+    def getSheet(self, examId, student_id):
+        self.cursor.execute("SELECT `answers` FROM `sheets` "
+                            "WHERE `exam_id`=? AND `student_id`=?",
+                            (examId, student_id))
+        row = self.cursor.fetchone()
+        return None if row is None else str(row[0])
+
+    def getSheets(self, examId, student_ids):
+        # packed sheets per student id of those that have one
+        sheets = {}
+        student_ids = list(student_ids)
+        for ids in chunks(student_ids):
+            self.cursor.execute("SELECT `student_id`, `answers` "
+                                "FROM `sheets` WHERE `exam_id`=? "
+                                "AND `student_id` IN (%s)" %
+                                ", ".join("?" * len(ids)), [examId] + ids)
+            sheets.update((sid, str(sheet))
+                          for sid, sheet in self.cursor.fetchall())
+        return sheets
+
+    def writeSheets(self, rows, commit=False):
+        # rows of (exam_id, student_id, sheet)
+        self.cursor.executemany("INSERT OR REPLACE INTO `sheets` "
+                                "(`exam_id`, `student_id`, `answers`) "
+                                "VALUES (?, ?, ?)",
+                                [(eid, sid, buffer(sheet))
+                                 for eid, sid, sheet in rows])
+        if commit:
+            self.conn.commit()
+
+    # SCORES ***********************
+    def getCachedScores(self, examId):
+        # students and their part scores from the cache in getExamSheets
+        # order, None if the exam was not scored since answers changed
+        self.cursor.execute("SELECT 1 FROM `scores` WHERE `exam_id`=? "
+                            "AND `student_id`=0", (examId,))
+        if self.cursor.fetchone() is None:
+            return None
+        self.cursor.execute("SELECT s.`student_id`, s.`student_num`, "
+                            "s.`name`, s.`bsa_code`, c.`part`, c.`score` "
+                            "FROM `scores` c JOIN `students` s "
+                            "ON s.`student_id` = c.`student_id` "
+                            "WHERE c.`exam_id`=? AND c.`student_id`!=0 "
+                            "ORDER BY c.`student_id`, c.`part`", (examId,))
+        students = []
+        scores = []
+        for row in self.cursor.fetchall():
+            if not students or students[-1]["student_id"] != row[0]:
+                students.append({"student_id": row[0],
+                                 "student_num": row[1],
+                                 "name": row[2],
+                                 "bsa_code": row[3]})
+                scores.append([0] * len(PART_ITEMS))
+            scores[-1][row[4] - 1] = row[5]
+        return students, scores
+
+    def saveScores(self, examId, keyCounts, students, scores, commit=True):
+        # cache part scores of students, keyCounts are the answered key
+        # items per part
+        self.clearScores(examId)
+        rows = [(examId, 0, part, count)
+                for part, count in enumerate(keyCounts, 1)]
+        for student, parts in zip(students, scores):
+            rows.extend((examId, student["student_id"], part, score)
+                        for part, score in enumerate(parts, 1))
+        self.cursor.executemany("INSERT INTO `scores` (`exam_id`, "
+                                "`student_id`, `part`, `score`) "
+                                "VALUES (?, ?, ?, ?)", rows)
+        if commit:
+            self.conn.commit()
+
+    def clearScores(self, examId):
+        self.cursor.execute("DELETE FROM `scores` WHERE `exam_id`=?",
+                            (examId,))
+
+    def getItemAnswers(self, examId, items):
+        # (student_id, answer) of the students who answered each of the
+        # (part, item) items, packed sheets are all read in one pass
+        answers = dict((x, []) for x in items)
+        if self.packed:
+            offsets = [(x, sheet_offset(*x)) for x in items]
+            self.cursor.execute("SELECT `student_id`, `answers` FROM `sheets` "
+                                "WHERE `exam_id`=? AND `student_id`!=0",
+                                (examId,))
+            for sid, sheet in self.cursor.fetchall():
+                sheet = str(sheet)
+                for x, offset in offsets:
+                    if sheet[offset] != BLANK:
+                        answers[x].append((sid, sheet[offset]))
+            return answers
+        for part, item in items:
+            self.cursor.execute(ITEM_ANSWERS_SQL, (examId, part, item))
+            answers[(part, item)] = self.cursor.fetchall()
+        return answers
+
+    def updateKeyScores(self, examId, changes):
+        # adjust cached scores for (part, item, old, new) key changes by
+        # reading only the answers to the changed items
+        self.cursor.execute("SELECT 1 FROM `scores` WHERE `exam_id`=? "
+                            "AND `student_id`=0", (examId,))
+        if self.cursor.fetchone() is None:
+            return
+        keys = {}
+        for part, item, old, new in changes:
+            try:
+                sheet_offset(part, item)
+            except ValueError:
+                # no student can answer items not on the sheet
+                continue
+            keys[(part, item)] = (sheet_answer(old).upper(),
+                                  sheet_answer(new).upper())
+        deltas = {}
+        answers = self.getItemAnswers(examId, keys.keys())
+        for (part, item), (old, new) in keys.iteritems():
+            key = (0, part)
+            deltas[key] = deltas.get(key, 0) + bool(new) - bool(old)
+            for sid, answer in answers[(part, item)]:
+                answer = answer.upper()
+                delta = (answer == new) - (answer == old)
+                if delta:
+                    deltas[(sid, part)] = deltas.get((sid, part), 0) + delta
+        self.cursor.executemany("UPDATE `scores` SET `score` = `score` + ? "
+                                "WHERE `exam_id`=? AND `student_id`=? "
+                                "AND `part`=?",
+                                [(d, examId, sid, p)
+                                 for (sid, p), d in deltas.iteritems() if d])
+
+    # JOBS ***********************
+    def insertJob(self, examId, files, scoring, status):
+        # batch of files read into the exam, every file starting with
+        # status. returns job_id
+        try:
+            self.cursor.execute("INSERT INTO `jobs` (`exam_id`, `scoring`, "
+                                "`created`) VALUES (?, ?, ?)",
+                                (examId, scoring, time.time()))
+            jobId = self.cursor.lastrowid
+            self.cursor.executemany("INSERT INTO `job_files` (`job_id`, "
+                                    "`seq`, `file`, `status`) "
+                                    "VALUES (?, ?, ?, ?)",
+                                    [(jobId, seq, fname, status)
+                                     for seq, fname in enumerate(files)])
+            self.commit()
+        except:
+            self.conn.rollback()
+            raise
+        return jobId
+
+    def getUnfinishedJobs(self, examId, scoring):
+        # ids of jobs of the exam not finished yet, latest first
+        self.cursor.execute("SELECT `job_id` FROM `jobs` WHERE `exam_id`=? "
+                            "AND `scoring`=? AND `finished` IS NULL "
+                            "ORDER BY `job_id` DESC", (examId, scoring))
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def deleteUnfinishedJobs(self, examId):
+        # jobs of the exam that will never be resumed, with their files
+        self.cursor.execute("DELETE FROM `jobs` WHERE `exam_id`=? "
+                            "AND `finished` IS NULL", (examId,))
+        self.conn.commit()
+
+    def getJobFiles(self, jobId):
+        # (file, status, page, data, timings, saved) rows in file order
+        self.cursor.execute("SELECT `file`, `status`, `page`, `data`, "
+                            "`timings`, `saved` FROM `job_files` "
+                            "WHERE `job_id`=? ORDER BY `seq`", (jobId,))
+        return self.cursor.fetchall()
+
+    def updateJobFile(self, jobId, fname, status, page=None, data=None,
+                      timings=None, commit=True):
+        # status of a file and what was read from it, data and timings
+        # are text
+        self.cursor.execute("UPDATE `job_files` SET `status`=?, `page`=?, "
+                            "`data`=?, `timings`=? "
+                            "WHERE `job_id`=? AND `file`=?",
+                            (status, page, data, timings, jobId, fname))
+        if commit:
+            self.conn.commit()
+
+    def setJobFilesSaved(self, jobId, files, commit=True):
+        # mark files whose answers are saved
+        for names in chunks(list(files), MAX_PARAMS - 1):
+            self.cursor.execute("UPDATE `job_files` SET `saved`=1 "
+                                "WHERE `job_id`=? AND `file` IN (%s)" %
+                                ", ".join("?" * len(names)),
+                                [jobId] + names)
+        if commit:
+            self.conn.commit()
+
+    def finishJob(self, jobId, keep=None):
+        # mark job finished, keeping only the latest keep finished jobs.
+        # pages read are only needed to resume, only statuses are kept
+        self.cursor.execute("UPDATE `jobs` SET `finished`=? "
+                            "WHERE `job_id`=?", (time.time(), jobId))
+        self.cursor.execute("UPDATE `job_files` SET `data`=NULL, "
+                            "`timings`=NULL WHERE `job_id`=?", (jobId,))
+        if keep is not None:
+            self.cursor.execute("DELETE FROM `jobs` WHERE `job_id` IN "
+                                "(SELECT `job_id` FROM `jobs` "
+                                "WHERE `finished` IS NOT NULL "
+                                "ORDER BY `job_id` DESC LIMIT -1 OFFSET ?)",
+                                (keep,))
+        self.conn.commit()
+
+    # ANSWERS **********************
+    def insertAnswer(self, exam_id, part, item, answer, student_id=0,
+                     commit=True):
+        self.clearScores(exam_id)
+        if self.packed:
+            sheet = pack_sheet([(part, item, answer)],
+                               self.getSheet(exam_id, student_id),
+                               student_id != 0)
+            self.writeSheets([(exam_id, student_id, sheet)], commit)
+            return None
+        self.cursor.execute("INSERT INTO `answers` (`exam_id`, `student_id`, "
+                            "`part`, `item`, `answer`) "
+                            "VALUES (?, ?, ?, ?, ?)", (exam_id, student_id,
+                                                       part, item, answer))
+        if commit:
+            self.conn.commit()
+        return self.cursor.lastrowid
+
+    def insertAnswers(self, rows, commit=True):
+        # rows of (exam_id, student_id, part, item, answer)
+        for eid in set(row[0] for row in rows):
+            self.clearScores(eid)
+        if self.packed:
+            for eid in set(row[0] for row in rows):
+                self.saveSheetAnswers(eid, [x for x in rows if x[0] == eid])
+            if commit:
+                self.conn.commit()
+            return
+        self.cursor.executemany("INSERT INTO `answers` (`exam_id`, "
+                                "`student_id`, `part`, `item`, `answer`) "
+                                "VALUES (?, ?, ?, ?, ?)", rows)
+        if commit:
+            self.conn.commit()
+
+
+if __name__ == "__main__":
+    import sys
+    # usage: database.py [--pack] [DATABASE] [EXAM_ID], prints query plans,
+    # --pack first moves answer rows into packed sheets
+    args = [x for x in sys.argv[1:] if x != "--pack"]
+    if len(args) > 0:
+        Database.database = args[0]
+    db = Database()
+    if "--pack" in sys.argv:
+        print "Packed %s answer sheet(s)" % db.packAnswers()
+    print "%s: schema version %s, %s storage" % (
+        db.database, db.schemaVersion(), PACKED if db.packed else "row")
+    slow = 0
+    for name, plan, indexed in db.checkQueryPlans(
+            int(args[1]) if len(args) > 1 else 0):
+        print "%s%s" % (name, "" if indexed else " (SCANS ANSWERS)")
+        for detail in plan:
+            print "    " + detail
+        slow += not indexed
+    sys.exit(1 if slow else 0)
@@ -1,5 +1,10 @@
-import math
+import collections
+import hashlib
+import json
+import multiprocessing
+import signal
 import sqlite3
+import time
 
 import cv2
 import numpy as np
@@ -7,6 +12,8 @@ import numpy as np
 
 # marker image for page one
 PAGE_MARKER = 'resources/page_marker.png'
+# positions of the circles in each page of the exam sheet
+SHEET_LAYOUT = 'resources/layout.json'
 # size of virtual page
 PAGE_SIZE = (2000, 3200)
 # color to check if black
@@ -16,6 +23,125 @@ COLOR_THRESHOLD = 50
 CIRC_SIZE = (32, 32)
 # distance between four points when checking inside the circle
 DIST_X, DIST_Y = map(lambda x: x * (3.0 / 8.0), CIRC_SIZE)
+# ways of scoring circles, count of the four sample points below the color
+# threshold or ratio of dark pixels in the whole circle box
+SCORING_POINTS = 'points'
+SCORING_AREA = 'area'
+SCORING = SCORING_POINTS
+# ratio of dark pixels for a circle to be considered filled
+FILL_RATIO = 0.25
+# downscale factor and margin around the expected position used when
+# looking for the page marker
+MARKER_SCALE = 2
+MARKER_MARGIN = 100
+# match score above which the page marker is not trusted, 0 is a perfect
+# match while a page without the marker scores around 0.4
+MARKER_THRESHOLD = 0.15
+# static resources shared by every page read, see load_resources
+RESOURCES = {}
+# downscale factor of the image used to look for the corner triangles
+CORNER_SCALE = 2
+# half size of the full resolution window used to refine each corner
+CORNER_WINDOW = 48
+# Profiler recording stage durations of each page read, None when disabled
+PROFILE = None
+# pages read before, by content of the image file, see ParseCache
+PARSE_CACHE = 'resources/cache.sqlite'
+# pages kept in the cache, the least recently used are removed first
+PARSE_CACHE_SIZE = 20000
+# change when changes to reading pages change the pages read
+PARSER_VERSION = 1
+# pages handed to each worker process before waiting for results
+IN_FLIGHT_PER_WORKER = 2
+# longest wait for a page read by a worker, waiting with a timeout
+# lets Ctrl-C interrupt it
+READ_TIMEOUT = 3600
+
+
+class Profiler(object):
+    """
+    Records how long each stage of reading a page takes, with counters
+    and values found along the way. Pages are added to totals per stage,
+    written as JSON lines to output and passed to callback
+    """
+    def __init__(self, output=None, callback=None):
+        self.output = output
+        self.callback = callback
+        self.pages = 0
+        self.stages = {}
+        self.counters = {}
+        self.record = None
+        self.last = None
+
+    def start(self, fname):
+        self.record = {"file": fname, "stages": {}, "counters": {}}
+        self.last = time.time()
+
+    def mark(self, stage):
+        # time since the previous mark is spent in stage
+        if self.record is None:
+            return
+        now = time.time()
+        stages = self.record["stages"]
+        stages[stage] = stages.get(stage, 0) + now - self.last
+        self.last = now
+
+    def count(self, name, value=1):
+        if self.record is not None:
+            counters = self.record["counters"]
+            counters[name] = counters.get(name, 0) + value
+
+    def value(self, name, value):
+        if self.record is not None:
+            self.record[name] = value
+
+    def finish(self):
+        """
+        returns record of the page being read
+        """
+        record, self.record = self.record, None
+        if record is not None:
+            record["total"] = sum(record["stages"].values())
+        return record
+
+    def add(self, record):
+        """
+        Add a finished page record, from this or a worker process
+        """
+        self.pages += 1
+        for stage, seconds in record["stages"].iteritems():
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+        for name, value in record["counters"].iteritems():
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.output is not None:
+            self.output.write(json.dumps(record, sort_keys=True) + "\n")
+        if self.callback is not None:
+            self.callback(record)
+
+    def summary(self):
+        """
+        returns dictionary of pages added, total seconds per stage and
+        counter totals
+        """
+        return {"pages": self.pages,
+                "stages": dict(self.stages),
+                "counters": dict(self.counters)}
+
+
+def enable_profiling(output=None, callback=None):
+    """
+    Start recording every page read, see Profiler
+
+    returns the Profiler
+    """
+    global PROFILE
+    PROFILE = Profiler(output, callback)
+    return PROFILE
+
+
+def disable_profiling():
+    global PROFILE
+    PROFILE = None
 
 
 def otsu(img):
@@ -28,17 +154,6 @@ def otsu(img):
     ret3,th3 = cv2.threshold(blur,0,255,cv2.THRESH_BINARY+cv2.THRESH_OTSU)
     return th3
 
-def thresholding(img):
-    """
-    Threshold image using adaptive gaussian algorithm
-
-    returns modified image object
-    """
-    ret,th1 = cv2.threshold(img,127,255,cv2.THRESH_BINARY)
-    return th1
-    return cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                 cv2.THRESH_BINARY, 11, 2)
-
 def show_img(img, window='image'):
     """
     Show image file in a window
@@ -52,80 +167,162 @@ def save_img(img, name):
     """
     cv2.imwrite(name,img)
 
-def isPixel(img, x, y):
+def sample_points(x, y):
     """
-    check if pixel is black
+    Compute the four points checked inside circles given the arrays of
+    their x and y positions
+
+    returns integer arrays of x and y coordinates with an extra axis
+    for the four points
     """
-    return img.item(y, x) < COLOR_THRESHOLD
+    x, y = np.broadcast_arrays(x, y)
+    xs = np.stack([x, x, x + DIST_X, x + DIST_X], axis=-1).astype(int)
+    ys = np.stack([y, y + DIST_Y, y, y + DIST_Y], axis=-1).astype(int)
+    return xs, ys
 
-def distance(x1, y1, x2, y2):
+def circle_boxes(x, y):
     """
-    retrieve distance between two points
+    Compute top left corner of the CIRC_SIZE box around circles, centered
+    on their four sample points, given arrays of their x and y positions
+
+    returns integer arrays of x and y coordinates
     """
-    return math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+    left = np.clip(x + (DIST_X - CIRC_SIZE[0]) / 2.0, 0,
+                   PAGE_SIZE[0] - CIRC_SIZE[0])
+    top = np.clip(y + (DIST_Y - CIRC_SIZE[1]) / 2.0, 0,
+                  PAGE_SIZE[1] - CIRC_SIZE[1])
+    return left.astype(int), top.astype(int)
 
-def isFilled(img, coors):
+def isFilled(img, xs, ys):
     """
-    count filled pixels
+    count filled pixels of each circle, given sample points from
+    sample_points
     """
-    return len([c for c in coors if isPixel(img, c[0], c[1])])
+    return (img[ys, xs] < COLOR_THRESHOLD).sum(axis=-1)
 
-def retrieve_relevant_area(fname):
+def load_image(fname):
     """
-    Retrieve relevant exam area from image
+    Decode image file once as grayscale
+
+    returns image object and its size as (width, height)
     """
-    img = cv2.imread(fname)
-    img_size = img.shape[:2][::-1]
     gray = cv2.imread(fname, 0)
-    #threshold using otsu
-    thresh = otsu(gray)
-    #save_img(thresh, 'otsu.png')
+    if gray is None:
+        raise IOError("Unable to read image file '%s'" % fname)
+    return gray, gray.shape[::-1]
+
+def find_triangle_vertices(img, mode=cv2.RETR_LIST):
+    """
+    Find vertices of triangle shapes in a grayscale image, mode is the
+    contour retrieval mode
 
-    # find shapes
-    ret, th = cv2.threshold(gray,127,255,1)
-    contours, h = cv2.findContours(th, 1, cv2.CHAIN_APPROX_SIMPLE)
-    # draw all contours
-    #cv2.drawContours(img, contours, -1, (0, 255,0), 1)
+    returns array of (x, y) vertices
+    """
+    ret, th = cv2.threshold(img,127,255,1)
+    # opencv 3 returns the image as well, contours are always second to last
+    contours = cv2.findContours(th, mode, cv2.CHAIN_APPROX_SIMPLE)[-2]
 
-    # get trianles
+    # get triangles
     triangles = []
-    for i, cnt in enumerate(contours):
+    for cnt in contours:
         vertices = cv2.approxPolyDP(cnt, 0.05*cv2.arcLength(cnt,True), True)
         if len(vertices) == 3:
-            triangles.append(vertices)
-            # draw detected triangles
-            #cv2.drawContours(img, contours, i, (255,0,0), 2)
-    
-    infinity = 999999999
-    top_left_cnt = infinity
-    top_right_cnt = infinity
-    bottom_left_cnt = infinity
-    bottom_right_cnt = infinity
-    top_left = (0, 0)
-    top_right = (0, 0)
-    bottom_left = (0, 0)
-    bottom_right = (0, 0)
-    
-    # calculate corners
-    for tri in [item[0] for sublist in triangles for item in sublist]:
-        x, y = tri
-        dst = distance(0, 0, x, y)
-        if top_left_cnt > dst:
-            top_left_cnt = dst
-            top_left = (x, y)
-        dst = distance(img_size[0], 0, x, y)
-        if top_right_cnt > dst:
-            top_right_cnt = dst
-            top_right = (x, y)
-        dst = distance(0, img_size[1], x, y)
-        if bottom_left_cnt > dst:
-            bottom_left_cnt = dst
-            bottom_left = (x, y)
-        dst = distance(img_size[0], img_size[1], x, y)
-        if bottom_right_cnt > dst:
-            bottom_right_cnt = dst
-            bottom_right = (x, y)
-    
+            triangles.append(vertices.reshape(3, 2))
+    if PROFILE:
+        PROFILE.count("contours", len(contours))
+        PROFILE.count("triangles", len(triangles))
+    if not triangles:
+        return np.empty((0, 2), np.int32)
+    return np.concatenate(triangles)
+
+def nearest_corners(vertices, corners):
+    """
+    Pick the vertex nearest to each of the given corners
+
+    returns array of (x, y) vertices ordered as the corners
+    """
+    delta = vertices[np.newaxis, :, :] - np.asarray(corners)[:, np.newaxis, :]
+    # squared distance keeps the order, first vertex found wins ties
+    return vertices[(delta ** 2).sum(axis=2).argmin(axis=1)]
+
+def find_corners(gray, img_size):
+    """
+    Find the page corner triangles, first on a downscaled copy of the image
+    and then only in small windows of the full resolution image
+
+    returns top left, top right, bottom left and bottom right vertices,
+    raises IOError when the page has fewer than 4 of them, as a blank
+    page does
+    """
+    w, h = img_size
+    corners = np.array([[0, 0], [w, 0], [0, h], [w, h]])
+
+    # subsample instead of averaging, averaging turns the edges of printed
+    # text grey and breaks it into thousands of small contours. the corner
+    # triangles sit outside of the answer boxes so nested shapes are skipped
+    coarse_size = (w // CORNER_SCALE, h // CORNER_SCALE)
+    coarse = cv2.resize(gray, coarse_size, interpolation=cv2.INTER_NEAREST)
+    vertices = find_triangle_vertices(coarse, cv2.RETR_EXTERNAL)
+    if len(vertices) < len(corners):
+        # not found when downscaled, search the whole image
+        vertices = find_triangle_vertices(gray)
+        if len(vertices) < len(corners):
+            raise IOError("Page corners not found")
+        return nearest_corners(vertices, corners)
+
+    points = nearest_corners(vertices, corners // CORNER_SCALE) * CORNER_SCALE
+    for i, (x, y) in enumerate(points):
+        left, top = max(x - CORNER_WINDOW, 0), max(y - CORNER_WINDOW, 0)
+        window = gray[top:y + CORNER_WINDOW, left:x + CORNER_WINDOW]
+        vertices = find_triangle_vertices(window)
+        if len(vertices):
+            offset = (left, top)
+            points[i] = nearest_corners(vertices + offset, corners[i:i + 1])[0]
+    return points
+
+def load_resources():
+    """
+    Load page marker template and other static data used for every page,
+    only once per process
+
+    returns dictionary of resources
+    """
+    if not RESOURCES:
+        template = cv2.imread(PAGE_MARKER,0)
+        if template is None:
+            raise IOError("Unable to read image file '%s'" % PAGE_MARKER)
+        h, w = template.shape
+        size = (w // MARKER_SCALE, h // MARKER_SCALE)
+        RESOURCES["marker"] = template
+        RESOURCES["marker_small"] = cv2.resize(template, size,
+                                               interpolation=cv2.INTER_AREA)
+        # corners of the virtual page the scans are skewed to
+        RESOURCES["page_corners"] = np.float32([[0,0], [PAGE_SIZE[0],0],
+                                                [0,PAGE_SIZE[1]], PAGE_SIZE])
+    return RESOURCES
+
+
+def warp_page(fname):
+    """
+    Retrieve relevant exam area from image, thresholded and skewed to
+    PAGE_SIZE
+
+    returns image object
+    """
+    gray, img_size = load_image(fname)
+    if PROFILE:
+        PROFILE.mark("decode")
+    #threshold using otsu
+    thresh = otsu(gray)
+    #save_img(thresh, 'otsu.png')
+    if PROFILE:
+        PROFILE.mark("threshold")
+
+    top_left, top_right, bottom_left, bottom_right = find_corners(gray,
+                                                                  img_size)
+    if PROFILE:
+        PROFILE.mark("corners")
+
     # draw page border
     #cv2.rectangle(img, top_left, bottom_right, (0,255,0), 10)
     #cv2.line(img, top_left, top_right,(255,0,255),5)
@@ -135,30 +332,255 @@ def retrieve_relevant_area(fname):
     
     #save_img(img, 'find_contours.png')
     
-    # skew perspective to corners
-    pts1 = np.float32([top_left, top_right, bottom_left, bottom_right])
-    pts2 = np.float32([[0,0],[PAGE_SIZE[0],0],[0,PAGE_SIZE[1]],PAGE_SIZE])
+    img = skew_page(thresh, (top_left, top_right, bottom_left, bottom_right))
+    if PROFILE:
+        PROFILE.mark("warp")
+    return img
+
+
+def skew_page(img, corners):
+    """
+    Skew perspective of image so the page corners (top left, top right,
+    bottom left, bottom right) become the corners of PAGE_SIZE
+
+    returns image object
+    """
+    pts1 = np.float32(corners)
+    pts2 = load_resources()["page_corners"]
     M = cv2.getPerspectiveTransform(pts1,pts2)
-    img = cv2.warpPerspective(thresh, M, PAGE_SIZE)
-    
+    return cv2.warpPerspective(img, M, PAGE_SIZE)
+
+
+def retrieve_relevant_area(fname):
+    """
+    Retrieve relevant exam area from image
+    """
+    img = warp_page(fname)
     # check if page one or two
-    # find marker on page
-    template = cv2.imread(PAGE_MARKER,0)
-    w, h = template.shape[::-1]
-    res = cv2.matchTemplate(img, template, cv2.TM_SQDIFF_NORMED)
-    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
-    top_left = min_loc
+    page, score, top_left = match_page_marker(img)
+    return img, page == "one"
+
+
+def match_page_marker(img):
+    """
+    Find marker on page, only around where the marker is on each page
+    and on copies of those regions scaled down by MARKER_SCALE
+
+    returns name of the best matching page, its match score from
+    0 (perfect) to 1 and top left of the marker
+    """
+    resources = load_resources()
+    h, w = resources["marker"].shape
+    small = resources["marker_small"]
+
+    best = None
+    for name in sorted(LAYOUT.pages):
+        x, y = LAYOUT.pages[name]["marker"]
+        left = max(x - MARKER_MARGIN, 0)
+        top = max(y - MARKER_MARGIN, 0)
+        roi = img[top:y + h + MARKER_MARGIN, left:x + w + MARKER_MARGIN]
+        size = (roi.shape[1] // MARKER_SCALE, roi.shape[0] // MARKER_SCALE)
+        roi = cv2.resize(roi, size, interpolation=cv2.INTER_AREA)
+        res = cv2.matchTemplate(roi, small, cv2.TM_SQDIFF_NORMED)
+        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
+        if best is None or min_val < best[1]:
+            top_left = (left + min_loc[0] * MARKER_SCALE,
+                        top + min_loc[1] * MARKER_SCALE)
+            best = (name, min_val, top_left)
+    return best
+
+
+def annotate_page(img, is_page_one):
+    """
+    Draw page marker and checked points of every circle onto a copy of
+    the page image, only needed to inspect how a page was read
+
+    returns annotated image object
+    """
+    img = img.copy()
+    page = LAYOUT.pages["one" if is_page_one else "two"]
+    h, w = load_resources()["marker"].shape
+    name, score, top_left = match_page_marker(img)
     bottom_right = (top_left[0] + w, top_left[1] + h)
+    cv2.rectangle(img, top_left, bottom_right, 128, 10)
+    img[page["ys"], page["xs"]] = 128
+    return img
 
-    # draw page one marker 
-    cv2.rectangle(img,top_left, bottom_right, 128, 10)
-    
-    # check position of marker to determine if page one or two
-    is_top_right = (top_left[0] > PAGE_SIZE[0] / 2 and
-                    top_left[1] < PAGE_SIZE[1] / 2)
-    
-    #save_img(img, 'find_page_one.png')
-    return img, is_top_right
+
+def pick_digits(fills):
+    """
+    Pick the filled digit per row of fill counts, last most filled wins
+
+    returns string of digits
+    """
+    vals = fills.shape[1] - 1 - fills[:, ::-1].argmax(axis=1)
+    return "".join(map(str, vals))
+
+
+def pick_choices(fills, letters="ABCDE", minimum=1):
+    """
+    Pick the filled choice per row of fill counts or ratios, first most
+    filled wins and it must be filled more than the minimum
+
+    returns list of letters, blank if no choice was filled
+    """
+    vals = fills.argmax(axis=1)
+    filled = fills.max(axis=1) > minimum
+    return [letters[val] if ok else " " for val, ok in zip(vals, filled)]
+
+
+def fill_ratios(img, left, top):
+    """
+    Compute the ratio of dark pixels inside circles given the top left
+    corners of their boxes, using one integral image of the page
+
+    returns array of ratios
+    """
+    ret, dark = cv2.threshold(img, COLOR_THRESHOLD - 1, 1,
+                              cv2.THRESH_BINARY_INV)
+    sums = cv2.integral(dark)
+    right, bottom = left + CIRC_SIZE[0], top + CIRC_SIZE[1]
+    count = (sums[bottom, right] - sums[top, right] -
+             sums[bottom, left] + sums[top, left])
+    return count / float(CIRC_SIZE[0] * CIRC_SIZE[1])
+
+
+def choice_confidence(ratios):
+    """
+    Compute how clearly each row of circles is filled or left blank,
+    from 0 (a circle is right at FILL_RATIO or several are filled) to 1
+
+    returns array of confidences
+    """
+    margin = np.abs(ratios - FILL_RATIO).min(axis=1)
+    confidence = np.minimum(margin / FILL_RATIO, 1.0)
+    confidence[(ratios > FILL_RATIO).sum(axis=1) > 1] = 0.0
+    return confidence
+
+
+class SheetLayout(object):
+    """
+    Positions of the student number and answer circles of the exam sheet,
+    loaded from a layout file and compiled into the sample points of
+    every circle of each page
+    """
+
+    def __init__(self, filename):
+        with open(filename) as f:
+            layout = json.load(f)
+        self.student_number = layout["student_number"]
+        self.choices = layout["choices"]
+        # json strings are unicode, answers are read as str
+        self.choices["letters"] = str(self.choices["letters"])
+        self.pages = {}
+        for name, page in layout["pages"].items():
+            self.pages[str(name)] = self.compile_page(page)
+
+    def circle_positions(self, spec, pos, cols, rows):
+        """
+        Compute first sample point of a grid of circles given its spacing
+        spec, position and number of columns and rows
+
+        returns arrays of x and y positions shaped (rows, cols)
+        """
+        pitch_x, pitch_y = spec["pitch"]
+        offset_x, offset_y = spec["offset"]
+        x = pos[0] + (np.arange(cols)[np.newaxis, :] *
+                      (CIRC_SIZE[0] * pitch_x) + (CIRC_SIZE[0] * offset_x))
+        y = pos[1] + (np.arange(rows)[:, np.newaxis] *
+                      (CIRC_SIZE[1] * pitch_y) + (CIRC_SIZE[1] * offset_y))
+        return np.broadcast_arrays(x, y)
+
+    def student_number_positions(self, pos):
+        """
+        Compute first sample point of the student number circles given
+        position of the top left circle
+
+        returns arrays of x and y positions shaped (digits, 10)
+        """
+        spec = self.student_number
+        xs, ys = [], []
+        for group in spec["groups"]:
+            gpos = (pos[0] + group["x"], pos[1])
+            x, y = self.circle_positions(spec, gpos, group["digits"], 10)
+            # one row per digit
+            xs.append(x.T)
+            ys.append(y.T)
+        return np.concatenate(xs), np.concatenate(ys)
+
+    def choice_positions(self, pos, length):
+        """
+        Compute first sample point of multiple choice circles given
+        position and question length
+
+        returns arrays of x and y positions shaped (length, choices)
+        """
+        cols = len(self.choices["letters"])
+        return self.circle_positions(self.choices, pos, cols, length)
+
+    def student_number_points(self, pos):
+        """
+        Compute sample points of the student number circles given position
+        of the top left circle
+
+        returns arrays of x and y coordinates shaped (digits, 10, 4)
+        """
+        return sample_points(*self.student_number_positions(pos))
+
+    def choice_points(self, pos, length):
+        """
+        Compute sample points of multiple choice circles given position
+        and question length
+
+        returns arrays of x and y coordinates shaped (length, choices, 4)
+        """
+        return sample_points(*self.choice_positions(pos, length))
+
+    def compile_page(self, page):
+        """
+        Compute sample points and bounding boxes of every circle in a page,
+        student number circles first and then each block of questions
+
+        returns dictionary with point coordinates shaped (circles, 4),
+        top left corner of the circles, number of digits per student
+        number group, the (part, item) of each question and where the
+        page marker is
+        """
+        x, y = self.student_number_positions(page["student_number"])
+        xs, ys = [x.ravel()], [y.ravel()]
+        items = []
+        for block in page["blocks"]:
+            x, y = self.choice_positions((block["x"], block["y"]),
+                                         block["items"])
+            xs.append(x.ravel())
+            ys.append(y.ravel())
+            # parts are numbered from zero when read
+            items.extend((block["part"] - 1, block["first"] + j)
+                         for j in range(block["items"]))
+        x, y = np.concatenate(xs), np.concatenate(ys)
+        px, py = sample_points(x, y)
+        left, top = circle_boxes(x, y)
+        return {"xs": px,
+                "ys": py,
+                "left": left,
+                "top": top,
+                "digits": [g["digits"] for g in self.student_number["groups"]],
+                "items": items,
+                "marker": tuple(page["marker"])}
+
+
+LAYOUT = SheetLayout(SHEET_LAYOUT)
+
+
+def format_student_number(digits, groups):
+    """
+    Join read digits into groups separated by dashes
+    """
+    vals = []
+    for length in groups:
+        vals.append(digits[:length])
+        digits = digits[length:]
+    return "-".join(vals)
 
 
 def read_student_number(img, pos):
@@ -167,38 +589,10 @@ def read_student_number(img, pos):
     
     Returns student number as string in the format YYYY-NNNNN
     """
-    num_pos = (pos[0] + 165, pos[1])
-    # size of the circle filled
-
-    def read_nums(pos, length):
-        vals = ""
-        for j in range(length):
-            val = -1
-            cnt = 0
-            for i in range(10):
-                x = pos[0] + (j * (CIRC_SIZE[0] * 1.045) +
-                              (CIRC_SIZE[0] * 0.35))
-                y = pos[1] + (i * (CIRC_SIZE[1] * 1.1868) +
-                              (CIRC_SIZE[1] * 0.37))
-                coor1 = (int(x), int(y))
-                coor2 = (int(x), int(y + DIST_Y))
-                coor3 = (int(x +DIST_X), int(y))
-                coor4 = (int(x +DIST_X), int(y + DIST_Y))
-
-                fillCnt = isFilled(img, [coor1, coor2, coor3, coor4])
-                if fillCnt >= cnt:
-                    cnt = fillCnt
-                    val = i
-                cv2.rectangle(img, coor1, coor1, 128, 1)
-                cv2.rectangle(img, coor2, coor2, 128, 1)
-                cv2.rectangle(img, coor3, coor3, 128, 1)
-                cv2.rectangle(img, coor4, coor4, 128, 1)
-            if val != - 1:
-                vals += str(val)
-        return vals
-                
-    # get student number
-    return "%s-%s" % (read_nums(pos, 4), read_nums(num_pos, 5))
+    xs, ys = LAYOUT.student_number_points(pos)
+    vals = pick_digits(isFilled(img, xs, ys))
+    groups = [g["digits"] for g in LAYOUT.student_number["groups"]]
+    return format_student_number(vals, groups)
 
 
 def read_choice(img, pos, length, start = 0):
@@ -208,142 +602,444 @@ def read_choice(img, pos, length, start = 0):
     
     return dictionary of answers 
     """
-    answers = {}
-    for j in range(length):
-        val = -1
-        cnt = 1
-        for i in range(5):
-            x = pos[0] + (i * (CIRC_SIZE[0] * 1.038) +
-                          (CIRC_SIZE[0] * 0.334))
-            y = pos[1] + (j * (CIRC_SIZE[1] * 1.1868) +
-                          (CIRC_SIZE[1] * 0.34))
-            coor1 = (int(x), int(y))
-            coor2 = (int(x), int(y + DIST_Y))
-            coor3 = (int(x +DIST_X), int(y))
-            coor4 = (int(x +DIST_X), int(y + DIST_Y))
-            
-            fillCnt = isFilled(img, [coor1, coor2, coor3, coor4])
-            if fillCnt > cnt:
-                cnt = fillCnt
-                val = i
-            cv2.rectangle(img, coor1, coor1, 128, 1)
-            cv2.rectangle(img, coor2, coor2, 128, 1)
-            cv2.rectangle(img, coor3, coor3, 128, 1)
-            cv2.rectangle(img, coor4, coor4, 128, 1)
-        if val != -1:
-            answers[start + j+1] = "ABCDE"[val]
-        else:
-            answers[start + j+1] = " "
-    return answers
-
-
-def read_page_one(img):
+    xs, ys = LAYOUT.choice_points(pos, length)
+    vals = pick_choices(isFilled(img, xs, ys), LAYOUT.choices["letters"])
+    return dict(enumerate(vals, start + 1))
+
+
+def read_page(img, page, scoring=None):
     """
-    Retrieve student number and answers (arranged by part) in page one
-    
-    returns dictionary
+    Read student number and answers of a page given its compiled
+    sample points, scoring is SCORING_POINTS or SCORING_AREA and
+    defaults to SCORING
+
+    returns dictionary, with the confidence of each answer when scoring
+    by area
     """
-    data = {"parts": {}}
+    scoring = scoring or SCORING
+    if scoring == SCORING_AREA:
+        fills = fill_ratios(img, page["left"], page["top"])
+        minimum = FILL_RATIO
+    else:
+        fills = isFilled(img, page["xs"], page["ys"])
+        minimum = 1
 
-    # read student number
-    # position of the top left circle
-    pos = (1632, 488)
-    data["student_num"] = read_student_number(img, pos)
+    # student number rows of 10 circles come first
+    ndigits = sum(page["digits"])
+    digits = fills[:ndigits * 10].reshape(ndigits, 10)
+    if scoring == SCORING_AREA:
+        # unfilled circles all count as empty, as with sample points
+        digits = np.where(digits > FILL_RATIO, digits, 0)
+    vals = pick_digits(digits)
+    data = {"student_num": format_student_number(vals, page["digits"]),
+            "parts": {}}
 
-    item_total = 55
-    box_y = 1090
+    letters = LAYOUT.choices["letters"]
+    fills = fills[ndigits * 10:].reshape(-1, len(letters))
+    answers = pick_choices(fills, letters, minimum)
+    for (part, item), ans in zip(page["items"], answers):
+        data["parts"].setdefault(part, {})[item] = ans
 
-    def read_parts(points):
-        ans = {}
-        total = 0
-        for point in points:
-            x, y, cnt = point
-            ta = read_choice(img, (x, y), cnt, total)
-            ans.update(ta)
-            total += cnt
-        return ans
+    if scoring == SCORING_AREA:
+        data["confidence"] = {}
+        confidence = choice_confidence(fills)
+        for (part, item), conf in zip(page["items"], confidence):
+            data["confidence"].setdefault(part, {})[item] = float(conf)
+    return data
 
-    # set positions for each parts
-    parts = [[70, 285], [500, 716], [930, 1147], [1362, 1578], [1794]]
-    
-    for i, part in enumerate(parts):
-        args = [(x, box_y, item_total) for x in part]
-        data["parts"][i] = read_parts(args)
+
+def read_page_one(img, scoring=None):
+    """
+    Retrieve student number and answers (arranged by part) in page one
     
-    return data
+    returns dictionary
+    """
+    return read_page(img, LAYOUT.pages["one"], scoring)
 
 
-def read_page_two(img):
+def read_page_two(img, scoring=None):
     """
     Retrieve student number and answers (arranged by part) in page two
 
     return dictionary
     """
-    data = {"parts": {}}
+    return read_page(img, LAYOUT.pages["two"], scoring)
 
-    # read student number
-    # position of the top left circle
-    pos = (1632, 2786)
-    data["student_num"] = read_student_number(img, pos)
 
-    box_y = 225
-    item_total = 55
+def read_image(fname, scoring=None):
+    """
+    Retrieve student number and answers from a single image file
 
-    # read part 5 continuation
-    data["parts"][4] = read_choice(img, (67, box_y), item_total, item_total)
-    
-    def read_parts(points):
-        ans = {}
-        total = 0
-        for point in points:
-            x, y, cnt = point
-            ta = read_choice(img, (x, y), cnt, total)
-            ans.update(ta)
-            total += cnt
-        return ans
-
-    # set positions for each parts (6-9)
-    parts = [[285, 500], [716, 930], [1147, 1362], [1578, 1794]]
-    
-    for i, part in enumerate(parts):
-        args = [(x, box_y, item_total) for x in part]
-        data["parts"][5 + i] = read_parts(args)
+    returns dictionary, files where the page marker was not clearly
+    found are listed in "flagged". When profiling, the record of the
+    page is in "profile"
+    """
+    return read_image_page(fname, scoring)[0]
 
-    # read part 1 continuation
-    box_y = 2423
-    parts = [67, 285, 500, 716, 930, 1147, 1362, 1578, 1794]
 
-    data["parts"][0] = {}
-    for i, x in enumerate(parts):
-        data["parts"][0].update(read_choice(img, (x, box_y), 1, 110 + i))
-    # read part 1 item 120
-    data["parts"][0].update(read_choice(img, (1794, 2461), 1, 119))
+def read_image_page(fname, scoring=None):
+    """
+    Same as read_image, also telling which page the image is
 
-    return data
+    returns dictionary, name of the page and its marker match score
+    """
+    if PROFILE:
+        PROFILE.start(fname)
+    img = warp_page(fname)
+    page, score, top_left = match_page_marker(img)
+    if PROFILE:
+        PROFILE.mark("marker")
+    data = read_page(img, LAYOUT.pages[page], scoring)
+    data["flagged"] = [fname] if score > MARKER_THRESHOLD else []
+    if PROFILE:
+        PROFILE.mark("read")
+        PROFILE.value("page", page)
+        PROFILE.value("marker_score", float(score))
+        data["profile"] = PROFILE.finish()
+    return data, page, score
+
+
+def merge_student_data(students, student_data):
+    """
+    Merge page data into the dictionary of data per student num
+    """
+    student_num = student_data["student_num"]
+    if student_num not in students:
+        students[student_num] = student_data
+    else:
+        data = students[student_num]
+        # both pages have items of the same parts, merge item by item
+        for part, items in student_data["parts"].iteritems():
+            data["parts"].setdefault(part, {}).update(items)
+        data["flagged"] = (data.get("flagged", []) +
+                           student_data.get("flagged", []))
+        if "confidence" in student_data:
+            confidence = data.setdefault("confidence", {})
+            for part, items in student_data["confidence"].iteritems():
+                confidence.setdefault(part, {}).update(items)
+
+
+def int_keys(parts, convert):
+    """
+    Turn part and item keys of values per item per part loaded from
+    JSON back into ints, values are passed to convert
+    """
+    return dict((int(part), dict((int(item), convert(value))
+                                 for item, value in items.iteritems()))
+                for part, items in parts.iteritems())
+
+
+class ParseCache(object):
+    """
+    Pages read before, by SHA-1 of the image file and the version of
+    the parser, layout, page marker and scoring that read them. Keeps
+    at most size pages, removing the least recently used ones
+    """
+    def __init__(self, filename=PARSE_CACHE, size=PARSE_CACHE_SIZE):
+        self.size = size
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS `pages` ("
+                          "`digest` TEXT NOT NULL, `version` TEXT NOT NULL, "
+                          "`data` TEXT NOT NULL, `used` REAL NOT NULL, "
+                          "PRIMARY KEY (`digest`, `version`))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS `pages_used` "
+                          "ON `pages` (`used`)")
+        self.versions = {}
+
+    def version(self, scoring):
+        if scoring not in self.versions:
+            sha = hashlib.sha1("%s %s " % (PARSER_VERSION, scoring))
+            for fname in (SHEET_LAYOUT, PAGE_MARKER):
+                with open(fname, "rb") as f:
+                    sha.update(f.read())
+            self.versions[scoring] = sha.hexdigest()
+        return self.versions[scoring]
+
+    def digest(self, fname):
+        """
+        returns SHA-1 of file content, None when it can't be read
+        """
+        try:
+            with open(fname, "rb") as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except IOError:
+            return None
+
+    def get(self, digest, fname, scoring):
+        """
+        returns page data as read_image does, the name of the page and
+        its marker match score, None when not cached
+        """
+        key = (digest, self.version(scoring))
+        row = self.conn.execute("SELECT `data` FROM `pages` "
+                                "WHERE `digest`=? AND `version`=?",
+                                key).fetchone()
+        if row is None:
+            return None
+        self.conn.execute("UPDATE `pages` SET `used`=? "
+                          "WHERE `digest`=? AND `version`=?",
+                          (time.time(),) + key)
+        cached = json.loads(row[0])
+        flagged = cached["score"] > MARKER_THRESHOLD
+        data = {"student_num": str(cached["student_num"]),
+                "parts": int_keys(cached["parts"], str),
+                "flagged": [fname] if flagged else []}
+        if "confidence" in cached:
+            data["confidence"] = int_keys(cached["confidence"], float)
+        return data, str(cached["page"]), cached["score"]
+
+    def put(self, digest, scoring, data, page, score):
+        cached = {"page": page, "score": float(score),
+                  "student_num": data["student_num"],
+                  "parts": data["parts"]}
+        if "confidence" in data:
+            cached["confidence"] = data["confidence"]
+        self.conn.execute("INSERT OR REPLACE INTO `pages` (`digest`, "
+                          "`version`, `data`, `used`) VALUES (?, ?, ?, ?)",
+                          (digest, self.version(scoring),
+                           json.dumps(cached), time.time()))
+
+    def commit(self):
+        # remove least recently used pages over size
+        self.conn.execute("DELETE FROM `pages` WHERE `rowid` IN "
+                          "(SELECT `rowid` FROM `pages` "
+                          "ORDER BY `used` DESC LIMIT -1 OFFSET ?)",
+                          (self.size,))
+        self.conn.commit()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+# one page read from an image file, data is None when the file could not
+# be read. timings has the seconds spent reading the page, per stage when
+# profiling, and is empty for pages found in the cache
+PageResult = collections.namedtuple(
+    "PageResult", "file page student_num data score cached timings")
+
+
+def read_page_result(fname, scoring=None):
+    """
+    Read a single image file, in this or a worker process
+
+    returns PageResult, without data when the file could not be read
+    """
+    start = time.time()
+    try:
+        data, page, score = read_image_page(fname, scoring)
+    except Exception:
+        # a corrupt image or a degenerate page can fail anywhere in
+        # opencv or numpy, only this file is unreadable, not the batch
+        return PageResult(fname, None, None, None, None, False, {})
+    return PageResult(fname, page, data["student_num"], data, float(score),
+                      False, {"total": time.time() - start})
+
+
+def cached_page(fname, scoring, cache):
+    """
+    Look up file in the parse cache
+
+    returns digest of the file, and its PageResult when found
+    """
+    if cache is None:
+        return None, None
+    digest = cache.digest(fname)
+    if digest is None:
+        return None, None
+    hit = cache.get(digest, fname, scoring)
+    if hit is None:
+        return digest, None
+    data, page, score = hit
+    return digest, PageResult(fname, page, data["student_num"], data, score,
+                              True, {})
+
+
+def finish_page(result, digest, scoring, cache):
+    """
+    Save a page just read in the parse cache and add its profile record
+    to its timings and to PROFILE
+
+    returns the PageResult
+    """
+    if result.data is None:
+        return result
+    if digest is not None:
+        cache.put(digest, scoring, result.data, result.page, result.score)
+    record = result.data.get("profile")
+    if record is not None:
+        result.timings.update(record["stages"])
+    profiled(result.data)
+    return result
+
+
+def check_images_generator(filenames, scoring=None, cache=None):
+    """
+    Read image files one after another, pages found in the ParseCache
+    cache are not read again
+
+    yields PageResult of each file in file order
+    """
+    scoring = scoring or SCORING
+    try:
+        for fname in filenames:
+            digest, result = cached_page(fname, scoring, cache)
+            if result is None:
+                result = finish_page(read_page_result(fname, scoring),
+                                     digest, scoring, cache)
+            yield result
+    finally:
+        if cache is not None:
+            cache.commit()
+
+
+def merge_pages(results, students=None):
+    """
+    Merge page results into the dictionary of data per student num,
+    raises IOError for files that could not be read
+
+    returns dictionary of data per student num
+    """
+    if students is None:
+        students = {}
+    for result in results:
+        if result.data is None:
+            raise IOError("Unable to read image file '%s'" % result.file)
+        merge_student_data(students, result.data)
+    return students
+
+
+class StudentPages(object):
+    """
+    Collects the pages read of each student, students are complete
+    when every page of the layout is read
+    """
+    def __init__(self, pages=None):
+        self.pages = set(pages or LAYOUT.pages)
+        self.waiting = {}
+        self.read = {}
+        self.complete = set()
+
+    def add(self, result):
+        """
+        Add the PageResult of a file read
+
+        returns dictionary of data per student num to save, empty while
+        the student is missing pages
+        """
+        student_num = result.student_num
+        if student_num in self.complete:
+            return {student_num: result.data}
+        merge_student_data(self.waiting, result.data)
+        read = self.read.setdefault(student_num, set())
+        read.add(result.page)
+        if read < self.pages:
+            return {}
+        self.complete.add(student_num)
+        del self.read[student_num]
+        return {student_num: self.waiting.pop(student_num)}
 
 
-def check_images_generator(filenames):
+def read_pages(filenames, pool, scoring=None, cache=None, in_flight=None):
+    """
+    Read image files with a pool of processes, at most in_flight pages
+    are read or waiting to be taken at any time, defaults to
+    IN_FLIGHT_PER_WORKER per cpu. Files are only listed as pages are
+    taken, pages in the cache are not read again
+
+    yields PageResult of each file in file order
+    """
+    scoring = scoring or SCORING
+    in_flight = in_flight or (IN_FLIGHT_PER_WORKER *
+                              multiprocessing.cpu_count())
+    pending = collections.deque()
+
+    def finish(digest, result, reading):
+        if result is not None:
+            return result
+        return finish_page(reading.get(READ_TIMEOUT), digest, scoring,
+                           cache)
+
+    for fname in filenames:
+        digest, result = cached_page(fname, scoring, cache)
+        reading = None
+        if result is None:
+            reading = pool.apply_async(read_page_result, (fname, scoring))
+        pending.append((digest, result, reading))
+        if len(pending) >= in_flight:
+            yield finish(*pending.popleft())
+    while pending:
+        yield finish(*pending.popleft())
+
+
+def profiled(student_data):
+    """
+    Add the profile record of page data read, by this or a worker
+    process, to PROFILE
+
+    returns page data without the record
+    """
+    record = student_data.pop("profile", None)
+    if record is not None and PROFILE:
+        PROFILE.add(record)
+    return student_data
+
+
+def _init_worker(profile=False):
+    """
+    Initialize pool worker process, profile records each page read
+    """
+    global PROFILE
+    # Ctrl-C is for the parent process, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # one process per core already, avoid oversubscribing opencv threads
+    cv2.setNumThreads(1)
+    load_resources()
+    # records are added to the PROFILE of the parent process
+    PROFILE = Profiler() if profile else None
+
+
+def create_pool(workers=None):
+    """
+    Start a pool of processes reading images, workers defaults to the
+    number of cpus. Pages are profiled when PROFILE is enabled
+
+    returns multiprocessing.Pool
+    """
+    return multiprocessing.Pool(workers, _init_worker, (bool(PROFILE),))
+
+
+def check_images_parallel(filenames, workers=None, scoring=None,
+                          cache=None):
+    """
+    Read image files using a pool of processes, workers defaults to the
+    number of cpus. Pages found in the ParseCache cache are not read
+    again
+
+    yields PageResult of each file in file order, as
+    check_images_generator does
+    """
+    pool = create_pool(workers)
+    try:
+        for result in read_pages(filenames, pool, scoring, cache,
+                                 workers and IN_FLIGHT_PER_WORKER * workers):
+            yield result
+        pool.close()
+    finally:
+        if cache is not None:
+            cache.commit()
+        pool.terminate()
+        pool.join()
+
+
+def check_images(filenames, scoring=None, cache=None):
     """
     get data from given set of filenames
 
     return dictionary of data per student num
     """
-    students = {}
-    for fname in filenames:
-        img, is_page_one = retrieve_relevant_area(fname)
-        if is_page_one:
-            student_data = read_page_one(img)
-        else:
-            student_data = read_page_two(img)
-        if student_data["student_num"] not in students.keys():
-            students[student_data["student_num"]] = student_data
-        else:
-            data = students[student_data["student_num"]]
-            data["parts"].update(student_data["parts"])
-        yield students
-
-def check_images(filenames):
-    return [x for x in check_images_generator(filenames)][-1]
+    return merge_pages(check_images_generator(filenames, scoring, cache))
 
 
 if __name__ == "__main__":
@@ -355,5 +1051,5 @@ if __name__ == "__main__":
     else:
         student_data = read_page_two(img)
 
-    save_img(img, 'result.png')
+    save_img(annotate_page(img, is_page_one), 'result.png')
     print student_data
@@ -0,0 +1,256 @@
+#!/usr/bin/python
+"""
+Grade exam papers without the user interface
+
+usage: grader.py EXAM_ID PATH [PATH ...] [-w WORKERS] [-r REPORT.xls]
+                 [-p PROFILE.jsonl]
+
+PATH can be an image file, a directory of images or a glob pattern.
+Answers are saved into the database the same way 'Read Exam Papers' does.
+Running again with the same images after an interruption resumes with
+the images not read yet.
+"""
+import argparse
+import glob
+import os
+import sys
+
+import examparser
+import jobs
+import ranking
+import scoring
+import xls
+from database import Database
+
+
+# spreadsheet template for reports
+REPORT_TEMPLATE = 'resources/rank.xls'
+# extensions of image files read from directories
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+
+def get_no_take_students(db, examId):
+    # add no take students
+    data = db.getNoTakeStudents(examId)
+    result = []
+    for row in data:
+        result.append({"name": row[0],
+                       "bsa_code": row[2],
+                       "student_num": row[1]})
+    return result
+
+
+def report_data(db, examId, raw_scores=None):
+    """
+    Compute scores and rankings of an exam
+
+    returns dictionary for xls.generate
+    """
+    if raw_scores is None:
+        raw_scores = scoring.compute_raw_scores(db, examId)
+    data = ranking.rank(raw_scores)
+    data.update({"raw_scores": raw_scores,
+                 "no_takes": get_no_take_students(db, examId),
+                 "students": sorted(raw_scores, key=lambda k: k["total"],
+                                    reverse=True)})
+    return data
+
+
+def save_students(db, examId, data, totals):
+    # save data per student num and add up counts in totals
+    counts = db.saveStudentAnswers(examId, data)
+    for name, count in counts.iteritems():
+        totals[name] += count
+    for stud_data in data.itervalues():
+        totals["flagged"].extend(stud_data.get("flagged", []))
+
+
+class BatchIngest(object):
+    """
+    Saves answers of each student as soon as all of their pages are
+    read, students still missing pages are saved after the last page.
+    With a jobs.Job every page is checkpointed and pages read before the
+    job was interrupted are taken up again
+    """
+    def __init__(self, db, examId, job=None):
+        self.db = db
+        self.examId = examId
+        self.job = job
+        self.students = examparser.StudentPages()
+        self.totals = {"read": 0, "students": 0, "inserted": 0,
+                       "replaced": 0, "flagged": [], "unreadable": []}
+        if job is not None:
+            self.totals["unreadable"].extend(job.failed())
+            for result, saved in job.parsed():
+                ready = self.students.add(result)
+                if ready and not saved:
+                    self.save(ready)
+
+    def save(self, data):
+        save_students(self.db, self.examId, data, self.totals)
+        if self.job is not None:
+            self.job.saved(data)
+
+    def add(self, result):
+        """
+        Add the examparser.PageResult of a file read
+        """
+        if self.job is not None:
+            self.job.record(result)
+        if result.data is None:
+            self.totals["unreadable"].append(result.file)
+            return
+        ready = self.students.add(result)
+        if ready:
+            self.save(ready)
+
+    def finish(self):
+        """
+        returns counts of students read and added, of answers inserted
+        and replaced and lists of flagged and unreadable files
+        """
+        students = self.students
+        self.totals["read"] = len(students.complete) + len(students.waiting)
+        if students.waiting:
+            self.save(students.waiting)
+        if self.job is not None:
+            self.job.finish()
+        return self.totals
+
+
+def ingest(db, examId, pages, progress=None, job=None):
+    """
+    Save the answers of pages read, see BatchIngest. pages are
+    examparser.PageResult as examparser.read_pages yields them,
+    progress is called with each of them
+
+    returns counts as BatchIngest.finish does
+    """
+    batch = BatchIngest(db, examId, job)
+    for result in pages:
+        if progress is not None:
+            progress(result)
+        batch.add(result)
+    return batch.finish()
+
+
+def find_images(paths):
+    """
+    Expand image files, directories and glob patterns
+
+    returns sorted list of file names
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    files.append(os.path.join(path, name))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            files.extend(glob.glob(path))
+    return sorted(set(files))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Read exam papers and save answers without the "
+                    "user interface")
+    parser.add_argument("exam_id", type=int, help="id of the exam")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+                        help="image file, directory or glob pattern")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="number of processes reading images "
+                             "(default: number of cpus)")
+    parser.add_argument("-r", "--report", metavar="FILE",
+                        help="also generate the spreadsheet report")
+    parser.add_argument("-s", "--scoring", default=examparser.SCORING,
+                        choices=[examparser.SCORING_POINTS,
+                                 examparser.SCORING_AREA],
+                        help="how circles are scored (default: %(default)s)")
+    parser.add_argument("-d", "--database", default=Database.database,
+                        help="database file (default: %(default)s)")
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="read every image again instead of using "
+                             "the pages read before from %s" %
+                             examparser.PARSE_CACHE)
+    parser.add_argument("-p", "--profile", metavar="FILE",
+                        help="write how long each stage of reading each "
+                             "page took to FILE as JSON lines")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    Database.database = args.database
+    db = Database()
+
+    if args.exam_id not in [x["exam_id"] for x in db.getExams()]:
+        print >>sys.stderr, "Exam %s not found" % args.exam_id
+        return 1
+
+    files = find_images(args.paths)
+    if not files:
+        print >>sys.stderr, "No image files found"
+        return 1
+
+    job = jobs.Job.start(db, args.exam_id, files, args.scoring)
+    pending = job.pending()
+    if job.resumed:
+        print "Resuming interrupted read, %s of %s image(s) left" % (
+            len(pending), len(files))
+
+    profile = None
+    if args.profile:
+        profile = examparser.enable_profiling(open(args.profile, "w"))
+    cache = examparser.ParseCache() if args.cache else None
+    pool = examparser.create_pool(args.workers)
+    progress = iter(range(1, len(pending) + 1))
+
+    def show(result):
+        print "[%s/%s] %s" % (next(progress), len(pending), result.file)
+        if result.data is None:
+            print >>sys.stderr, "Unable to read image file: %s" % result.file
+
+    try:
+        pages = examparser.read_pages(
+            pending, pool, args.scoring, cache,
+            args.workers and examparser.IN_FLIGHT_PER_WORKER * args.workers)
+        totals = ingest(db, args.exam_id, pages, show, job)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if cache is not None:
+            cache.close()
+        if profile is not None:
+            examparser.disable_profiling()
+            profile.output.close()
+    if profile is not None:
+        summary = profile.summary()
+        for stage, seconds in sorted(summary["stages"].iteritems(),
+                                     key=lambda x: x[1], reverse=True):
+            print "%-10s %8.1f ms per page" % (stage, seconds * 1000 /
+                                              max(summary["pages"], 1))
+        print "Profile saved to: %s" % args.profile
+
+    print "Read %s image(s) of %s student(s)" % (len(files), totals["read"])
+    print ("%(students)s student(s) added, %(inserted)s answer(s) saved, "
+           "%(replaced)s replaced" % totals)
+    for fname in totals["flagged"]:
+        print "Could not clearly tell page one from page two: %s" % fname
+
+    if args.report:
+        raw_scores = scoring.compute_raw_scores(db, args.exam_id)
+        if not raw_scores:
+            print >>sys.stderr, "No test papers read, report not generated"
+            return 1
+        xls.generate(REPORT_TEMPLATE, args.report,
+                     report_data(db, args.exam_id, raw_scores))
+        print "Spreadsheet saved to: %s" % args.report
+    return 1 if totals["unreadable"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
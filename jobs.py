@@ -0,0 +1,140 @@
+"""
+Batches of image files read into an exam, checkpointed in the database
+file by file so a batch interrupted by closing the application or a
+crash resumes with only the files not read yet
+"""
+import codecs
+import json
+import sys
+
+import examparser
+
+
+# status of each file of a job
+PENDING = "pending"
+PARSED = "parsed"
+FAILED = "failed"
+# finished jobs kept in the database with the status of each file
+JOB_HISTORY = 10
+# file names are byte strings, stored as text in this encoding. under
+# the C locale python reports ascii, names are taken as utf-8 then
+FS_ENCODING = sys.getfilesystemencoding() or "utf-8"
+if codecs.lookup(FS_ENCODING).name == "ascii":
+    FS_ENCODING = "utf-8"
+
+
+def stored_name(fname):
+    # file name as text for the database
+    if isinstance(fname, unicode):
+        return fname
+    return fname.decode(FS_ENCODING)
+
+
+def encode_page(data):
+    # page data as text, without its profile record
+    return json.dumps(dict((k, v) for k, v in data.iteritems()
+                           if k != "profile"), encoding=FS_ENCODING)
+
+
+def decode_page(text):
+    data = json.loads(text)
+    page = {"student_num": str(data["student_num"]),
+            "parts": examparser.int_keys(data["parts"], str),
+            "flagged": [x.encode(FS_ENCODING)
+                        for x in data.get("flagged", [])]}
+    if "confidence" in data:
+        page["confidence"] = examparser.int_keys(data["confidence"], float)
+    return page
+
+
+class Job(object):
+    """
+    Status of every file of a batch read into an exam, with the page
+    read from it and which pages have their answers saved
+    """
+    def __init__(self, db, jobId, files, resumed=False):
+        self.db = db
+        self.jobId = jobId
+        # file, status, page, data, timings, saved rows in file order,
+        # file names as the byte strings they were given as
+        self.files = [(row[0].encode(FS_ENCODING),) + tuple(row[1:])
+                      for row in files]
+        self.resumed = resumed
+        # files of students whose answers are not saved yet
+        self.unsaved = {}
+
+    @classmethod
+    def start(cls, db, examId, files, scoring=None):
+        """
+        Resume the unfinished job reading the same files into the exam
+        with the same scoring, or start a new one. Other unfinished jobs
+        of the exam would never be resumed and are removed then
+
+        returns Job
+        """
+        scoring = scoring or examparser.SCORING
+        files = list(files)
+        for jobId in db.getUnfinishedJobs(examId, scoring):
+            job = cls(db, jobId, db.getJobFiles(jobId), resumed=True)
+            if [row[0] for row in job.files] == files:
+                return job
+        db.deleteUnfinishedJobs(examId)
+        jobId = db.insertJob(examId, map(stored_name, files), scoring,
+                             PENDING)
+        return cls(db, jobId, db.getJobFiles(jobId))
+
+    def pending(self):
+        """
+        returns files not read yet
+        """
+        return [row[0] for row in self.files if row[1] == PENDING]
+
+    def failed(self):
+        """
+        returns files that could not be read
+        """
+        return [row[0] for row in self.files if row[1] == FAILED]
+
+    def parsed(self):
+        """
+        Pages read before the job was interrupted
+
+        yields examparser.PageResult and whether its answers are saved,
+        in file order
+        """
+        for fname, status, page, data, timings, saved in self.files:
+            if status != PARSED:
+                continue
+            data = decode_page(data)
+            result = examparser.PageResult(fname, str(page),
+                                           data["student_num"], data, None,
+                                           True, json.loads(timings))
+            if not saved:
+                self.unsaved.setdefault(result.student_num, []).append(fname)
+            yield result, bool(saved)
+
+    def record(self, result):
+        """
+        Checkpoint the PageResult of a file just read
+        """
+        if result.data is None:
+            self.db.updateJobFile(self.jobId, stored_name(result.file),
+                                  FAILED)
+            return
+        self.db.updateJobFile(self.jobId, stored_name(result.file), PARSED,
+                              result.page, encode_page(result.data),
+                              json.dumps(result.timings))
+        self.unsaved.setdefault(result.student_num, []).append(result.file)
+
+    def saved(self, data):
+        """
+        Mark the pages of students in data per student num as saved
+        """
+        files = []
+        for student_num in data:
+            files.extend(self.unsaved.pop(student_num, []))
+        if files:
+            self.db.setJobFilesSaved(self.jobId, map(stored_name, files))
+
+    def finish(self):
+        self.db.finishJob(self.jobId, JOB_HISTORY)
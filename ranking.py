@@ -0,0 +1,66 @@
+import heapq
+
+
+# students listed per part, overall and as successful examinees,
+# more are listed when they tie with the last one
+PART_TOP = 3
+TOP_STUDENTS = 10
+SUCCESS_STUDENTS = 30
+
+
+def cutoffs(rows, counts):
+    """
+    Find the lowest score that still makes each top list in one pass,
+    keeping only the best scores per key in a heap
+
+    counts is a list of (key, num), returns the cutoff score per
+    (key, num) or None when every row makes the list
+    """
+    sizes = {}
+    for key, num in counts:
+        sizes[key] = max(num, sizes.get(key, 0))
+    heaps = dict((key, []) for key in sizes)
+    for row in rows:
+        for key, size in sizes.iteritems():
+            heap = heaps[key]
+            if len(heap) < size:
+                heapq.heappush(heap, row[key])
+            elif row[key] > heap[0]:
+                heapq.heapreplace(heap, row[key])
+    result = {}
+    for key, num in counts:
+        best = heapq.nlargest(num, heaps[key])
+        result[(key, num)] = best[-1] if len(best) == num else None
+    return result
+
+
+def top_rows(rows, key, cutoff):
+    """
+    Rows scoring at least cutoff, best first, ties in the order of rows
+    """
+    if cutoff is not None:
+        rows = [row for row in rows if row[key] >= cutoff]
+    return sorted(rows, key=lambda k: k[key], reverse=True)
+
+
+def rank(raw_scores, part_top=PART_TOP, top=TOP_STUDENTS,
+         success=SUCCESS_STUDENTS):
+    """
+    Rank students per part and by total in one pass over the scores
+
+    returns dictionary with subject_top, top_students and
+    success_students for xls.generate
+    """
+    parts = ["part" + str(i) for i in range(1, 10)]
+    counts = [(x, part_top) for x in parts] + [("total", top),
+                                              ("total", success)]
+    limits = cutoffs(raw_scores, counts)
+    subject_top = {}
+    for i, part in enumerate(parts, 1):
+        subject_top[i] = top_rows(raw_scores, part,
+                                  limits[(part, part_top)])
+    return {"subject_top": subject_top,
+            "top_students": top_rows(raw_scores, "total",
+                                     limits[("total", top)]),
+            "success_students": top_rows(raw_scores, "total",
+                                         limits[("total", success)])}
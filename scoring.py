@@ -0,0 +1,76 @@
+import numpy as np
+
+from database import PART_OFFSETS, SHEET_SIZE
+
+
+def sheet_matrix(sheets):
+    """
+    Stack packed answer sheets into a students x items uint8 array,
+    lowercase answers are made uppercase
+    """
+    if not sheets:
+        return np.zeros((0, SHEET_SIZE), np.uint8)
+    matrix = np.frombuffer("".join(str(x) for x in sheets), np.uint8)
+    matrix = matrix.reshape(len(sheets), SHEET_SIZE)
+    lower = (matrix >= ord("a")) & (matrix <= ord("z"))
+    return np.where(lower, matrix - 32, matrix).astype(np.uint8)
+
+
+def score_matrix(key, answers):
+    """
+    Count correct answers per part, blank answers are never correct
+
+    returns students x parts int array
+    """
+    correct = (answers == key) & (answers != 0)
+    return np.add.reduceat(correct.astype(np.int32), PART_OFFSETS, axis=1)
+
+
+def part_scores(key, sheets):
+    """
+    Score packed sheets against the packed answer key
+
+    returns students x parts int array
+    """
+    return score_matrix(sheet_matrix([key])[0], sheet_matrix(sheets))
+
+
+def key_counts(key):
+    """
+    Count the answered items per part of the packed answer key
+    """
+    answered = sheet_matrix([key]) != 0
+    return np.add.reduceat(answered.astype(np.int32), PART_OFFSETS,
+                           axis=1)[0]
+
+
+def raw_score_rows(students, scores):
+    """
+    Format part scores of students for xls.generate
+    """
+    raw = []
+    for student, row in zip(students, scores):
+        data = {"name": student["name"],
+                "bsa_code": student["bsa_code"],
+                "student_num": student["student_num"],
+                "total": sum(row)}
+        for prt, score in enumerate(row, 1):
+            data["part" + str(prt)] = score
+        raw.append(data)
+    return raw
+
+
+def compute_raw_scores(db, examId):
+    """
+    Score every student who took the exam against the answer key,
+    scores are cached until student answers are saved again
+
+    returns list of score rows for xls.generate
+    """
+    cached = db.getCachedScores(examId)
+    if cached is not None:
+        return raw_score_rows(*cached)
+    key, students, sheets = db.getExamSheets(examId)
+    scores = part_scores(key, sheets).tolist()
+    db.saveScores(examId, key_counts(key).tolist(), students, scores)
+    return raw_score_rows(students, scores)
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+"""
+Read exam papers while a scanner saves them into a folder
+
+usage: watcher.py EXAM_ID DIR [DIR ...] [-w WORKERS] [-i SECONDS]
+                  [--idle SECONDS]
+
+Images already in the folders are read first, then every new image as
+soon as it is completely written. Answers of a student are saved once
+both of their pages are read, later pages of the same student are saved
+right away. Stop with Ctrl-C.
+"""
+import argparse
+import os
+import sys
+import time
+
+import examparser
+import grader
+from database import Database
+
+
+# seconds between looking for new files
+POLL_INTERVAL = 2.0
+# last bytes of a completely written jpeg file
+JPEG_END = "\xff\xd9"
+
+
+def complete_image(fname):
+    """
+    Tell whether an image file looks completely written, jpeg files
+    end with the end of image marker
+    """
+    if not fname.lower().endswith((".jpg", ".jpeg")):
+        return True
+    try:
+        with open(fname, "rb") as f:
+            f.seek(-len(JPEG_END), os.SEEK_END)
+            return f.read() == JPEG_END
+    except (IOError, OSError):
+        return False
+
+
+class FolderWatcher(object):
+    """
+    Finds image files in folders that stopped changing since they were
+    last seen
+    """
+    def __init__(self, paths, extensions=grader.IMAGE_EXTENSIONS):
+        self.paths = paths
+        self.extensions = extensions
+        # size and modification time per file when last polled
+        self.seen = {}
+        self.done = set()
+        # size and modification time of files that could not be read
+        self.failed = {}
+
+    def poll(self):
+        """
+        returns sorted list of files not returned before that kept
+        their size and modification time since the previous poll
+        """
+        ready = []
+        for path in self.paths:
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+            for name in names:
+                fname = os.path.join(path, name)
+                if (not name.lower().endswith(self.extensions) or
+                        fname in self.done):
+                    continue
+                try:
+                    stat = os.stat(fname)
+                except OSError:
+                    continue
+                state = (stat.st_size, stat.st_mtime)
+                if (state[0] > 0 and self.seen.get(fname) == state and
+                        self.failed.get(fname) != state and
+                        complete_image(fname)):
+                    ready.append(fname)
+                self.seen[fname] = state
+        self.done.update(ready)
+        return sorted(ready)
+
+    def retry(self, fname):
+        """
+        Return file again once it changes, it could not be read
+        """
+        self.done.discard(fname)
+        self.failed[fname] = self.seen.get(fname)
+
+
+def watch(db, examId, paths, pool, scoring=None, cache=None,
+          interval=POLL_INTERVAL, idle=None):
+    """
+    Read new image files in paths until interrupted, or until no new
+    file was found for idle seconds
+
+    returns dictionary of data per student num of students still
+    missing pages
+    """
+    scoring = scoring or examparser.SCORING
+    watcher = FolderWatcher(paths)
+    students = examparser.StudentPages()
+    last_file = time.time()
+    try:
+        while True:
+            files = watcher.poll()
+            if files:
+                last_file = time.time()
+            elif idle and time.time() - last_file >= idle:
+                break
+            pages = examparser.read_pages(files, pool, scoring, cache)
+            for result in pages:
+                if result.data is None:
+                    print >>sys.stderr, "Unable to read, retrying once it " \
+                                        "changes: %s" % result.file
+                    watcher.retry(result.file)
+                    continue
+                print "Read page %s of %s: %s" % (result.page,
+                                                  result.student_num,
+                                                  result.file)
+                if result.data["flagged"]:
+                    print ("Could not clearly tell page one from page two: "
+                           "%s" % result.file)
+                ready = students.add(result)
+                if ready:
+                    counts = db.saveStudentAnswers(examId, ready)
+                    print ("Saved %s: %s answer(s) saved, %s replaced" %
+                           (result.student_num, counts["inserted"],
+                            counts["replaced"]))
+            if cache is not None:
+                cache.commit()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    return students.waiting
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Read exam papers while a scanner saves them into a "
+                    "folder")
+    parser.add_argument("exam_id", type=int, help="id of the exam")
+    parser.add_argument("paths", nargs="+", metavar="DIR",
+                        help="folder the scanner saves images into")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="number of processes reading images "
+                             "(default: number of cpus)")
+    parser.add_argument("-i", "--interval", type=float,
+                        default=POLL_INTERVAL,
+                        help="seconds between looking for new images "
+                             "(default: %(default)s)")
+    parser.add_argument("--idle", type=float, default=None,
+                        metavar="SECONDS",
+                        help="stop when no new image was found for "
+                             "SECONDS")
+    parser.add_argument("-s", "--scoring", default=examparser.SCORING,
+                        choices=[examparser.SCORING_POINTS,
+                                 examparser.SCORING_AREA],
+                        help="how circles are scored (default: %(default)s)")
+    parser.add_argument("-d", "--database", default=Database.database,
+                        help="database file (default: %(default)s)")
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="read every image again instead of using "
+                             "the pages read before from %s" %
+                             examparser.PARSE_CACHE)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    Database.database = args.database
+    db = Database()
+
+    if args.exam_id not in [x["exam_id"] for x in db.getExams()]:
+        print >>sys.stderr, "Exam %s not found" % args.exam_id
+        return 1
+    for path in args.paths:
+        if not os.path.isdir(path):
+            print >>sys.stderr, "Not a folder: %s" % path
+            return 1
+
+    cache = examparser.ParseCache() if args.cache else None
+    pool = examparser.create_pool(args.workers)
+    try:
+        waiting = watch(db, args.exam_id, args.paths, pool, args.scoring,
+                        cache, args.interval, args.idle)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if cache is not None:
+            cache.close()
+
+    # not saved, they are read again from the cache on the next run
+    for student_num in sorted(waiting):
+        print "Missing a page, not saved: %s" % student_num
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,5 @@
 import math
+import struct
 from decimal import Decimal
 
 from xlrd import open_workbook
@@ -50,13 +51,88 @@ STYLE_COLHEADER = easyxf('font: name Calibri, bold true, height 200;'
                          'borders: left thin, right thin, bottom thin;')
 STYLE_PERCENT = easyxf('font: name Calibri, bold true, height 240;'
                        'borders: left thin, right thin, top thin, bottom thin;')
+STYLE_PARTHEADER = easyxf('font: name Calibri, bold true, height 240;'
+                          'pattern: pattern solid, fore_colour gray25;'
+                          'align: vertical center;'
+                          'borders: bottom thin;')
+
+# columns after the row number written for each student
+SCORE_KEYS = ["name", "student_num", "bsa_code",
+              "part1", "part2", "part3", "part4", "part5",
+              "part6", "part7", "part8", "part9", "total"]
+# rows kept in memory per sheet before they are written to a temp file
+FLUSH_ROWS = 500
+# templates read by xlrd, copied for each spreadsheet
+TEMPLATES = {}
+
+
+class RowFormula(Formula):
+    """
+    Formula already compiled by a FormulaPattern
+    """
+    __slots__ = ["_text", "_rpn"]
+
+    def __init__(self, text, rpn):
+        self._text = text
+        self._rpn = rpn
+
+    def get_references(self):
+        return [], []
+
+    def text(self):
+        return self._text
+
+    def rpn(self):
+        return self._rpn
+
+
+class FormulaPattern(object):
+    """
+    Formula with {0} for the row number of its own cells, parsed once.
+    Formulas of other rows only get the row numbers changed
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        first = Formula(pattern.format(1)).rpn()
+        # row 258 is 0x0101, both bytes of every row number differ
+        other = Formula(pattern.format(258)).rpn()
+        self.rpn = bytearray(first)
+        self.offsets = [i for i in range(len(first))
+                        if first[i] != other[i]][::2]
+
+    def formula(self, rowx):
+        rpn = self.rpn[:]
+        for offset in self.offsets:
+            struct.pack_into("<H", rpn, offset, rowx)
+        return RowFormula(self.pattern.format(rowx + 1), str(rpn))
+
+
+PERCENT_FORMULA = FormulaPattern("M{0}/N{0}")
+
 
 class ExcelGenerator(object):
     def copy(self, filename):
-        rb = open_workbook(filename)
-        wb = copy(rb)
+        if filename not in TEMPLATES:
+            TEMPLATES[filename] = open_workbook(filename)
+        wb = copy(TEMPLATES[filename])
         return wb
 
+    def writeScores(self, srow, number, row, items=None):
+        srow.write(0, number, STYLE_DEFAULT)
+        for col, key in enumerate(SCORE_KEYS, 1):
+            srow.write(col, row[key], STYLE_DEFAULT)
+        if items is not None:
+            formula = PERCENT_FORMULA.formula(srow.get_index())
+            srow.write(14, items, STYLE_DEFAULT)
+            srow.write(15, formula, STYLE_DECIMAL)
+            srow.write(16, 1, STYLE_PERFECT)
+            srow.write(17, formula, STYLE_PERCENTAGE)
+
+    def flushRows(self, sheet, rowx, template_rows):
+        # rows of the template can't be written once flushed
+        if rowx > template_rows and rowx % FLUSH_ROWS == 0:
+            sheet.flush_row_data()
+
     def setHeaders(self, sheet, title=""):
         sheet.row(0).write(0, HEADER_TITLE, STYLE_HEADER)
         sheet.row(1).write(0, HEADER_SUBTITLE, STYLE_HEADER)
@@ -108,22 +184,10 @@ class ExcelGenerator(object):
         self.setHeaders(sheet, "ROSTER OF SCORES")
         self.setSubheaders(sheet, False)
         
+        template_rows = sheet.last_used_row
         for rcnt, row in enumerate(data, start_row):
-            srow = sheet.row(rcnt)
-            srow.write(0, rcnt - start_row + 1, STYLE_DEFAULT)
-            srow.write(1, row["name"], STYLE_DEFAULT)
-            srow.write(2, row["student_num"], STYLE_DEFAULT)
-            srow.write(3, row["bsa_code"], STYLE_DEFAULT)
-            srow.write(4, row["part1"], STYLE_DEFAULT)
-            srow.write(5, row["part2"], STYLE_DEFAULT)
-            srow.write(6, row["part3"], STYLE_DEFAULT)
-            srow.write(7, row["part4"], STYLE_DEFAULT)
-            srow.write(8, row["part5"], STYLE_DEFAULT)
-            srow.write(9, row["part6"], STYLE_DEFAULT)
-            srow.write(10, row["part7"], STYLE_DEFAULT)
-            srow.write(11, row["part8"], STYLE_DEFAULT)
-            srow.write(12, row["part9"], STYLE_DEFAULT)
-            srow.write(13, row["total"], STYLE_DEFAULT)
+            self.writeScores(sheet.row(rcnt), rcnt - start_row + 1, row)
+            self.flushRows(sheet, rcnt, template_rows)
 
 
     def addNoTakes(self, wb, data):
@@ -133,6 +197,7 @@ class ExcelGenerator(object):
         self.setHeaders(sheet, "ROSTER OF SCORES")
         self.setSubheaders(sheet, False)
         
+        template_rows = sheet.last_used_row
         for rcnt, row in enumerate(data, start_row):
             srow = sheet.row(rcnt)
             srow.write(0, rcnt - start_row + 1, STYLE_DEFAULT)
@@ -141,6 +206,7 @@ class ExcelGenerator(object):
             srow.write(3, row["bsa_code"], STYLE_DEFAULT)
             for cnt in range(4, 14):
                 srow.write(cnt, 0, STYLE_DEFAULT)
+            self.flushRows(sheet, rcnt, template_rows)
 
 
     def addSubjectTop(self, wb, data):
@@ -161,10 +227,7 @@ class ExcelGenerator(object):
         self.setHeaders(sheet, "TOP 3 PER SUBJECT AREA")
         sheet.col(1).width =  15500
         
-        style = easyxf('font: name Calibri, bold true, height 240;'
-                       'pattern: pattern solid, fore_colour gray25;'
-                       'align: vertical center;'
-                       'borders: bottom thin;')
+        style = STYLE_PARTHEADER
         
         for p in range(1, 10):
             rank = 0
@@ -200,27 +263,11 @@ class ExcelGenerator(object):
         self.setHeaders(sheet, "AIEX ROSTER OF EXAM PERCENTAGES")
         self.setSubheaders(sheet)
         
+        template_rows = sheet.last_used_row
         for rcnt, row in enumerate(data, start_row):
-            formula = Formula("M%s/N%s" % (rcnt + 1, rcnt + 1))
-            srow = sheet.row(rcnt)
-            srow.write(0, rcnt - start_row + 1, STYLE_DEFAULT)
-            srow.write(1, row["name"], STYLE_DEFAULT)
-            srow.write(2, row["student_num"], STYLE_DEFAULT)
-            srow.write(3, row["bsa_code"], STYLE_DEFAULT)
-            srow.write(4, row["part1"], STYLE_DEFAULT)
-            srow.write(5, row["part2"], STYLE_DEFAULT)
-            srow.write(6, row["part3"], STYLE_DEFAULT)
-            srow.write(7, row["part4"], STYLE_DEFAULT)
-            srow.write(8, row["part5"], STYLE_DEFAULT)
-            srow.write(9, row["part6"], STYLE_DEFAULT)
-            srow.write(10, row["part7"], STYLE_DEFAULT)
-            srow.write(11, row["part8"], STYLE_DEFAULT)
-            srow.write(12, row["part9"], STYLE_DEFAULT)
-            srow.write(13, row["total"], STYLE_DEFAULT)
-            srow.write(14, items, STYLE_DEFAULT)
-            srow.write(15, formula, STYLE_DECIMAL)
-            srow.write(16, 1, STYLE_PERFECT)
-            srow.write(17, formula, STYLE_PERCENTAGE)
+            self.writeScores(sheet.row(rcnt), rcnt - start_row + 1, row,
+                             items)
+            self.flushRows(sheet, rcnt, template_rows)
 
 
     def addSuccess(self, wb, data):
@@ -233,27 +280,11 @@ class ExcelGenerator(object):
         self.setHeaders(sheet, "AIEX ROSTER OF SUCCESSFUL EXAMINEES")
         self.setSubheaders(sheet)
         
+        template_rows = sheet.last_used_row
         for rcnt, row in enumerate(data, start_row):
-            formula = Formula("M%s/N%s" % (rcnt + 1, rcnt + 1))
-            srow = sheet.row(rcnt)
-            srow.write(0, rcnt - start_row + 1, STYLE_DEFAULT)
-            srow.write(1, row["name"], STYLE_DEFAULT)
-            srow.write(2, row["student_num"], STYLE_DEFAULT)
-            srow.write(3, row["bsa_code"], STYLE_DEFAULT)
-            srow.write(4, row["part1"], STYLE_DEFAULT)
-            srow.write(5, row["part2"], STYLE_DEFAULT)
-            srow.write(6, row["part3"], STYLE_DEFAULT)
-            srow.write(7, row["part4"], STYLE_DEFAULT)
-            srow.write(8, row["part5"], STYLE_DEFAULT)
-            srow.write(9, row["part6"], STYLE_DEFAULT)
-            srow.write(10, row["part7"], STYLE_DEFAULT)
-            srow.write(11, row["part8"], STYLE_DEFAULT)
-            srow.write(12, row["part9"], STYLE_DEFAULT)
-            srow.write(13, row["total"], STYLE_DEFAULT)
-            srow.write(14, items, STYLE_DEFAULT)
-            srow.write(15, formula, STYLE_DECIMAL)
-            srow.write(16, 1, STYLE_PERFECT)
-            srow.write(17, formula, STYLE_PERCENTAGE)
+            self.writeScores(sheet.row(rcnt), rcnt - start_row + 1, row,
+                             items)
+            self.flushRows(sheet, rcnt, template_rows)
 
 
     def addTopStudents(self, wb, data):
@@ -266,27 +297,11 @@ class ExcelGenerator(object):
         self.setHeaders(sheet, "AIEX TOP TEN PERFORMERS")
         self.setSubheaders(sheet)
         
+        template_rows = sheet.last_used_row
         for rcnt, row in enumerate(data, start_row):
-            formula = Formula("M%s/N%s" % (rcnt + 1, rcnt + 1))
-            srow = sheet.row(rcnt)
-            srow.write(0, rcnt - start_row + 1, STYLE_DEFAULT)
-            srow.write(1, row["name"], STYLE_DEFAULT)
-            srow.write(2, row["student_num"], STYLE_DEFAULT)
-            srow.write(3, row["bsa_code"], STYLE_DEFAULT)
-            srow.write(4, row["part1"], STYLE_DEFAULT)
-            srow.write(5, row["part2"], STYLE_DEFAULT)
-            srow.write(6, row["part3"], STYLE_DEFAULT)
-            srow.write(7, row["part4"], STYLE_DEFAULT)
-            srow.write(8, row["part5"], STYLE_DEFAULT)
-            srow.write(9, row["part6"], STYLE_DEFAULT)
-            srow.write(10, row["part7"], STYLE_DEFAULT)
-            srow.write(11, row["part8"], STYLE_DEFAULT)
-            srow.write(12, row["part9"], STYLE_DEFAULT)
-            srow.write(13, row["total"], STYLE_DEFAULT)
-            srow.write(14, items, STYLE_DEFAULT)
-            srow.write(15, formula, STYLE_DECIMAL)
-            srow.write(16, 1, STYLE_PERFECT)
-            srow.write(17, formula, STYLE_PERCENTAGE)
+            self.writeScores(sheet.row(rcnt), rcnt - start_row + 1, row,
+                             items)
+            self.flushRows(sheet, rcnt, template_rows)
 
 
     def saveExcelFile(self, wb, filename):